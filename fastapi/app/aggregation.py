@@ -0,0 +1,151 @@
+import os
+import re
+from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException
+from sqlalchemy import func, select, cast, BigInteger, Float, DateTime, String, table, column
+from sqlalchemy.orm import Session
+
+from models import Observation
+
+
+AGGREGATE_FUNCTIONS = ("avg", "min", "max", "sum", "count", "first", "last")
+
+# Read from the continuous aggregates created by init_database_aggregates when they fit the query
+AGGREGATE_USE_VIEWS = os.getenv("AGGREGATE_USE_VIEWS", "true").lower() == "true"
+
+
+def _aggregate_view(name):
+    return table(
+        name,
+        column("bucket", DateTime(timezone=True)),
+        column("datastream_id", String),
+        *[column(f, Float) for f in ("avg", "min", "max", "sum")],
+        column("count", BigInteger),
+        column("first", Float),
+        column("last", Float),
+    )
+
+# Coarsest first
+AGGREGATE_VIEWS = [
+    (timedelta(days=1), _aggregate_view("observations_daily")),
+    (timedelta(hours=1), _aggregate_view("observations_hourly")),
+]
+
+# Default time_bucket origin for timestamptz (a Monday, midnight UTC)
+BUCKET_ORIGIN = datetime(2000, 1, 3, tzinfo=timezone.utc)
+
+_UNITS = {
+    "s": "seconds", "sec": "seconds", "second": "seconds", "seconds": "seconds",
+    "m": "minutes", "min": "minutes", "minute": "minutes", "minutes": "minutes",
+    "h": "hours", "hour": "hours", "hours": "hours",
+    "d": "days", "day": "days", "days": "days",
+    "w": "weeks", "week": "weeks", "weeks": "weeks",
+}
+_SIMPLE = re.compile(r"^\s*(\d+)\s*([a-z]+)\s*$")
+_ISO = re.compile(r"^P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$")
+
+
+def parse_interval(value):
+    """Bucket width from "15min", "1 hour", "7d" or an ISO 8601 duration such as "PT15M" """
+    match = _SIMPLE.match(value.lower())
+    if match and match.group(2) in _UNITS:
+        interval = timedelta(**{_UNITS[match.group(2)]: int(match.group(1))})
+    else:
+        match = _ISO.match(value.upper())
+        if not match or not any(match.groups()):
+            raise HTTPException(status_code=400, detail=f"Invalid interval {value!r}")
+        weeks, days, hours, minutes, seconds = (int(g or 0) for g in match.groups())
+        interval = timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds)
+    if interval <= timedelta(0):
+        raise HTTPException(status_code=400, detail="Interval must be positive")
+    return interval
+
+
+def parse_functions(value):
+    functions = [f.strip().lower() for f in value.split(",") if f.strip()]
+    unknown = [f for f in functions if f not in AGGREGATE_FUNCTIONS]
+    if not functions or unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown aggregate functions {unknown}, expected some of {list(AGGREGATE_FUNCTIONS)}"
+        )
+    return functions
+
+
+def _aggregate(name, result, time):
+    if name in ("first", "last"):
+        # TimescaleDB first()/last(): value at the earliest/latest time of the bucket
+        return getattr(func, name)(result, time)
+    if name == "count":
+        return func.count(result)
+    return getattr(func, name)(result)
+
+
+def _aligned(time, width):
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return (time - BUCKET_ORIGIN) % width == timedelta(0)
+
+
+def pick_view(interval, time_start=None, time_end=None):
+    """Coarsest continuous aggregate whose buckets tile the requested buckets and range, if any"""
+    if not AGGREGATE_USE_VIEWS:
+        return None
+    for width, view in AGGREGATE_VIEWS:
+        if interval % width:
+            continue
+        if time_start is not None and not _aligned(time_start, width):
+            continue
+        if time_end is not None and not _aligned(time_end, width):
+            continue
+        return view
+    return None
+
+
+def _reaggregate(name, view):
+    """Combine pre-aggregated buckets into coarser ones"""
+    if name == "avg":
+        return func.sum(view.c.sum) / func.nullif(func.sum(view.c.count), 0)
+    if name == "count":
+        return cast(func.sum(view.c.count), BigInteger)
+    if name in ("first", "last"):
+        return getattr(func, name)(view.c[name], view.c.bucket)
+    if name == "sum":
+        return func.sum(view.c.sum)
+    return getattr(func, name)(view.c[name])
+
+
+## TIME BUCKET AGGREGATION ____________________________________________
+def aggregate_observations(db: Session, datastream_id, interval, functions, time_start=None, time_end=None):
+    """One row per time_bucket of the datastream's observations in [time_start, time_end), computed in the database.
+
+    Returns (source, rows), source being the continuous aggregate read, or
+    "observations" when the raw rows had to be aggregated.
+    """
+    view = pick_view(interval, time_start, time_end)
+    if view is not None:
+        bucket = func.time_bucket(interval, view.c.bucket).label("bucket")
+        stmt = select(
+            bucket, *[_reaggregate(f, view).label(f) for f in functions]
+        ).where(view.c.datastream_id == datastream_id)
+        # Range bounds fall on view buckets: [time_start, time_end)
+        if time_start:
+            stmt = stmt.where(view.c.bucket >= time_start)
+        if time_end:
+            stmt = stmt.where(view.c.bucket < time_end)
+        stmt = stmt.group_by("bucket").order_by("bucket")
+        return view.name, [dict(row._mapping) for row in db.execute(stmt)]
+
+    bucket = func.time_bucket(interval, Observation.phenomenonTime).label("bucket")
+    stmt = select(
+        bucket,
+        *[_aggregate(f, Observation.result, Observation.phenomenonTime).label(f) for f in functions]
+    ).where(Observation.datastream_id == datastream_id)
+    # Same [time_start, time_end) as the views, whichever source answers
+    if time_start:
+        stmt = stmt.where(Observation.phenomenonTime >= time_start)
+    if time_end:
+        stmt = stmt.where(Observation.phenomenonTime < time_end)
+    # By label: the bucket expression has its own bound interval
+    stmt = stmt.group_by("bucket").order_by("bucket")
+    return "observations", [dict(row._mapping) for row in db.execute(stmt)]
@@ -0,0 +1,111 @@
+"""Collection encode benchmark: FastAPI's encoding of ORM rows vs the field-plan path.
+
+Builds a page of synthetic Observations (no database needed) and times, per
+page, the encoding of the response body:
+
+- orm: what list routes did, ORM objects in "value" walked by
+  jsonable_encoder, then json.dumps (the response_model=Dict[str, Any] path)
+- schema: ObservationResponse validation and JSON dump of every row
+- plan: rows as tuples, EntityPlan.dicts and orjson (serialization.json_response)
+
+It also checks that the plan output is byte-identical to the schema output.
+
+Examples (from the app directory):
+    python bench/encode_bench.py --rows 1000 --repeat 50
+    python bench/encode_bench.py --rows 10000 --output results.jsonl
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Encoding only: the engines are created but never connected
+os.environ.setdefault("DB_STARTUP_RETRIES", "0")
+os.environ.setdefault("DB_STARTUP_REQUIRED", "false")
+
+from typing import List
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from models import Observation
+from schemas import ObservationResponse
+from serialization import ENTITY_PLANS, json_response
+from pagination import collection
+
+
+def synthetic_rows(n):
+    """(ORM objects, tuples in plan column order) of the same n observations"""
+    plan = ENTITY_PLANS[Observation]
+    start = datetime.now(timezone.utc).replace(microsecond=0)
+    objects, tuples = [], []
+    for i in range(n):
+        values = {
+            "id": i,
+            "phenomenonTime": start - timedelta(seconds=i),
+            "resultTime": start - timedelta(seconds=i) if i % 2 else None,
+            "result": round(random.uniform(-10, 40), 3),
+            "resultQuality": {"flag": "ok"} if i % 10 == 0 else None,
+            "parameters": {"battery": round(random.uniform(3, 4), 2)},
+            "raw": None,
+            "datastream_id": "7b1c3c0e-8a43-4d2e-9a57-1f7f0e4b9c21",
+            "feature_of_interest_id": None,
+        }
+        objects.append(Observation(**values))
+        tuples.append(tuple(values[column.key] for column in plan.columns))
+    return objects, tuples
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000, help="observations per page")
+    parser.add_argument("--repeat", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="append the result as a JSON line to this file")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    plan = ENTITY_PLANS[Observation]
+    objects, tuples = synthetic_rows(args.rows)
+    schema_list = TypeAdapter(List[ObservationResponse])
+
+    paths = {
+        "orm": lambda: json.dumps(jsonable_encoder(collection(objects))).encode(),
+        "schema": lambda: schema_list.dump_json(schema_list.validate_python(objects, from_attributes=True), by_alias=True),
+        "plan": lambda: json_response(collection(plan.dicts(tuples))).body,
+    }
+
+    # The plan path must write what the *Response schema writes
+    expected = paths["schema"]()
+    identical = json_response(plan.dicts(tuples)).body == expected
+
+    result = {"rows": args.rows, "identical_to_schema": identical}
+    for name, fn in paths.items():
+        result[f"{name}_ms"] = timed(fn, args.repeat) * 1000
+    result["speedup_vs_orm"] = result["orm_ms"] / result["plan_ms"]
+    result["speedup_vs_schema"] = result["schema_ms"] / result["plan_ms"]
+    result["at"] = datetime.now(timezone.utc).isoformat()
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
+    if not identical:
+        sys.exit("plan output differs from the ObservationResponse schema")
+
+
+if __name__ == "__main__":
+    main()
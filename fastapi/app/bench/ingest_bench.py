@@ -0,0 +1,386 @@
+"""Ingest throughput benchmark.
+
+Creates synthetic Things/Datastreams in the configured database, replays
+messages at a given rate and reports sustained msgs/s, p50/p99 end-to-end
+latency and database rows/s.
+
+- mqtt path: messages go through mqtt_listener.on_message, the ingest queue
+  and the batch writers, published by an in-process stand-in broker.
+  Latency is measured from publish to commit.
+- http path: dataArray requests to POST /v1.0/CreateObservations through
+  the ASGI app, one batched INSERT per request. Latency is the request round trip.
+- http-row path: one observation per POST /v1.0/Observations request, each
+  committed on its own, for comparison with the batched paths.
+
+--path can be repeated: the paths run one after the other on the same
+fixtures and each reports its own result.
+
+Examples (from the app directory):
+    python bench/ingest_bench.py --path mqtt --things 100 --properties 5 --rate 2000 --duration 30
+    python bench/ingest_bench.py --path http --shape array --samples 500 --concurrency 8
+    python bench/ingest_bench.py --path http --path http-row --concurrency 8
+    python bench/ingest_bench.py --output results.json --baseline previous.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# No broker and no API-side listener: the benchmark drives the ingest path itself
+os.environ.setdefault("MQTT_LISTENER_ENABLED", "false")
+os.environ.setdefault("INGEST_LOG_SAMPLE_RATE", "0")
+os.environ.setdefault("SPOOL_DIR", tempfile.mkdtemp(prefix="bdoh-bench-spool-"))
+
+import msgpack
+from sqlalchemy import delete, func
+
+from database import SessionLocal
+from models import Thing, Sensor, ObservedProperty, Datastream, Observation
+
+SHAPES = ("single", "array", "pairs", "msgpack")
+PATHS = ("mqtt", "http", "http-row")
+
+
+## FIXTURES ___________________________________________________________
+def create_fixtures(run_id, n_things, n_properties):
+    """Synthetic Things x ObservedProperties, one Datastream each. Returns (topic, datastream_id) pairs"""
+    session = SessionLocal()
+    try:
+        sensor = Sensor(name=f"bench-{run_id}", encodingType="application/json")
+        props = [
+            ObservedProperty(name=f"bench-{run_id}-p{j}", definition="urn:bdoh:bench")
+            for j in range(n_properties)
+        ]
+        things = [
+            Thing(name=f"bench-{run_id}-t{i}", properties={"bench": run_id})
+            for i in range(n_things)
+        ]
+        session.add_all([sensor, *props, *things])
+        session.flush()
+
+        routes = []
+        for thing in things:
+            for prop in props:
+                ds = Datastream(
+                    name=f"{thing.name}-{prop.name}",
+                    unitOfMeasurement={"name": "unit", "symbol": "u", "definition": "urn:bdoh:bench"},
+                    thing_id=thing.id,
+                    sensor_id=sensor.id,
+                    observed_property_id=prop.id,
+                )
+                session.add(ds)
+                routes.append((f"iot/{thing.id}/{prop.name}", ds))
+        session.commit()
+        return [(topic, ds.id) for topic, ds in routes]
+    finally:
+        session.close()
+
+
+def drop_fixtures(run_id, ds_ids):
+    session = SessionLocal()
+    try:
+        session.execute(delete(Observation).where(Observation.datastream_id.in_(ds_ids)))
+        session.execute(delete(Datastream).where(Datastream.id.in_(ds_ids)))
+        session.execute(delete(Thing).where(Thing.name.like(f"bench-{run_id}-%")))
+        session.execute(delete(ObservedProperty).where(ObservedProperty.name.like(f"bench-{run_id}-%")))
+        session.execute(delete(Sensor).where(Sensor.name == f"bench-{run_id}"))
+        session.commit()
+    finally:
+        session.close()
+
+
+def count_rows(ds_ids):
+    session = SessionLocal()
+    try:
+        return session.query(func.count()).select_from(Observation).filter(
+            Observation.datastream_id.in_(ds_ids)
+        ).scalar()
+    finally:
+        session.close()
+
+
+## MESSAGES ___________________________________________________________
+class Clock:
+    """Unique millisecond phenomenonTimes, so no sample is a duplicate"""
+
+    def __init__(self):
+        self._next = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(days=1)
+        self._lock = threading.Lock()
+
+    def take(self, n):
+        with self._lock:
+            start = self._next
+            self._next += timedelta(milliseconds=n)
+        return [start + timedelta(milliseconds=i) for i in range(n)]
+
+
+def time_key(ds_id, value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return ds_id, round(value.timestamp() * 1000)
+
+
+def encode(shape, times):
+    """MQTT payload and properties for one message carrying len(times) samples"""
+    values = [round(random.uniform(-10, 40), 3) for _ in times]
+    if shape == "single":
+        return json.dumps({"phenomenonTime": times[0].isoformat(), "result": values[0]}).encode(), None
+    if shape == "array":
+        return json.dumps([
+            {"phenomenonTime": t.isoformat(), "result": v} for t, v in zip(times, values)
+        ]).encode(), None
+    pairs = [[t.timestamp(), v] for t, v in zip(times, values)]
+    if shape == "pairs":
+        return json.dumps(pairs).encode(), None
+    return msgpack.packb(pairs), SimpleNamespace(ContentType="application/msgpack", UserProperty=[])
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * (len(values) - 1) + 0.5))]
+
+
+def schedule(rate, duration):
+    """Yield, once per message to send, how long to wait before sending it.
+
+    Messages are spaced for `rate` per second (0 = as fast as possible) for `duration` seconds.
+    """
+    start = time.perf_counter()
+    end = start + duration
+    interval = 1 / rate if rate else 0
+    next_at = start
+    while True:
+        now = time.perf_counter()
+        if now >= end:
+            return
+        yield max(next_at - now, 0)
+        next_at += interval
+
+
+## MQTT PATH __________________________________________________________
+class StandInBroker:
+    """Delivers published messages straight to the listener callback, like paho's network thread would"""
+
+    def __init__(self, on_message):
+        self.on_message = on_message
+
+    def publish(self, topic, payload, properties=None):
+        self.on_message(None, None, SimpleNamespace(topic=topic, payload=payload, properties=properties))
+
+
+def run_mqtt(args, routes):
+    import ingest_writer
+    import mqtt_listener
+
+    sent = {}
+    latencies = []
+    write = ingest_writer.write_observations
+
+    # Time each row from publish to commit
+    def timed_write(rows, *a, **kw):
+        write(rows, *a, **kw)
+        done = time.perf_counter()
+        for row in rows:
+            t0 = sent.pop(time_key(row["datastream_id"], row["phenomenonTime"]), None)
+            if t0 is not None:
+                latencies.append(done - t0)
+
+    ingest_writer.write_observations = timed_write
+    broker = StandInBroker(mqtt_listener.on_message)
+    clock = Clock()
+    mqtt_listener.pool.start()
+
+    messages = 0
+    start = time.perf_counter()
+    try:
+        for delay in schedule(args.rate, args.duration):
+            if delay:
+                time.sleep(delay)
+            topic, ds_id = random.choice(routes)
+            times = clock.take(args.samples if args.shape != "single" else 1)
+            payload, properties = encode(args.shape, times)
+            now = time.perf_counter()
+            for t in times:
+                sent[time_key(ds_id, t)] = now
+            broker.publish(topic, payload, properties)
+            messages += 1
+    finally:
+        # Drains the queue and flushes every writer
+        mqtt_listener.pool.stop()
+        ingest_writer.write_observations = write
+    elapsed = time.perf_counter() - start
+    return messages, elapsed, latencies, mqtt_listener.stats()
+
+
+## HTTP PATHS _________________________________________________________
+def create_observations_request(ds_id, clock, samples):
+    """POST /v1.0/CreateObservations: `samples` observations in one dataArray"""
+    body = [{
+        "Datastream": {"@iot.id": ds_id},
+        "components": ["phenomenonTime", "result"],
+        "dataArray": [[t.isoformat(), round(random.uniform(-10, 40), 3)] for t in clock.take(samples)],
+    }]
+    return "/v1.0/CreateObservations", body, 201
+
+
+def observation_request(ds_id, clock, samples=1):
+    """POST /v1.0/Observations: a single observation"""
+    body = {
+        "phenomenonTime": clock.take(1)[0].isoformat(),
+        "result": round(random.uniform(-10, 40), 3),
+        "datastream_id": ds_id,
+    }
+    return "/v1.0/Observations/", body, 200
+
+
+def run_http(args, routes, request=create_observations_request):
+    import httpx
+    from main import app
+
+    clock = Clock()
+    latencies = []
+    errors = 0
+    samples = args.samples if args.shape != "single" else 1
+
+    async def send(client, sem):
+        nonlocal errors
+        _, ds_id = random.choice(routes)
+        url, body, expected = request(ds_id, clock, samples)
+        try:
+            t0 = time.perf_counter()
+            response = await client.post(url, json=body)
+            latencies.append(time.perf_counter() - t0)
+            if response.status_code != expected:
+                errors += 1
+        finally:
+            sem.release()
+
+    async def main():
+        sem = asyncio.Semaphore(args.concurrency)
+        tasks = []
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for delay in schedule(args.rate, args.duration):
+                await asyncio.sleep(delay)
+                await sem.acquire()
+                tasks.append(asyncio.create_task(send(client, sem)))
+            await asyncio.gather(*tasks)
+        return len(tasks)
+
+    start = time.perf_counter()
+    messages = asyncio.run(main())
+    elapsed = time.perf_counter() - start
+    return messages, elapsed, latencies, {"errors": errors}
+
+
+def run_http_row(args, routes):
+    return run_http(args, routes, request=observation_request)
+
+
+RUNNERS = {"mqtt": run_mqtt, "http": run_http, "http-row": run_http_row}
+
+
+## REPORT _____________________________________________________________
+def compare(result, baseline, tolerance):
+    """Regressions of result against a baseline result of the same path and shape"""
+    regressions = []
+    if result["msgs_per_s"] < baseline["msgs_per_s"] * (1 - tolerance):
+        regressions.append(f"msgs/s {result['msgs_per_s']:.0f} < baseline {baseline['msgs_per_s']:.0f}")
+    if baseline.get("latency_p99_ms") and result["latency_p99_ms"] and \
+            result["latency_p99_ms"] > baseline["latency_p99_ms"] * (1 + tolerance):
+        regressions.append(f"p99 {result['latency_p99_ms']:.1f} ms > baseline {baseline['latency_p99_ms']:.1f} ms")
+    return regressions
+
+
+def report(args, path, topics, messages, elapsed, rows, latencies, extra):
+    p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+    return {
+        "path": path,
+        "shape": args.shape if path != "http-row" else "single",
+        "samples": args.samples if args.shape != "single" and path != "http-row" else 1,
+        "topics": topics,
+        "rate": args.rate,
+        "duration": args.duration,
+        "messages": messages,
+        "elapsed_s": round(elapsed, 3),
+        "msgs_per_s": messages / elapsed,
+        "db_rows": rows,
+        "db_rows_per_s": rows / elapsed,
+        "latency_p50_ms": p50 * 1000 if p50 is not None else None,
+        "latency_p99_ms": p99 * 1000 if p99 is not None else None,
+        "at": datetime.now(timezone.utc).isoformat(),
+        **extra,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--path", choices=PATHS, action="append", help="repeatable, default: mqtt")
+    parser.add_argument("--shape", choices=SHAPES, default="single")
+    parser.add_argument("--samples", type=int, default=100, help="observations per message (array shapes)")
+    parser.add_argument("--things", type=int, default=50)
+    parser.add_argument("--properties", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=0, help="messages per second, 0 = unthrottled")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=4, help="in-flight HTTP requests")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="keep the synthetic entities and rows")
+    parser.add_argument("--output", help="append the result as a JSON line to this file")
+    parser.add_argument("--baseline", help="JSON lines file of previous results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed regression ratio")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    paths = args.path or ["mqtt"]
+    run_id = uuid.uuid4().hex[:8]
+    routes = create_fixtures(run_id, args.things, args.properties)
+    ds_ids = [ds_id for _, ds_id in routes]
+    results = []
+    try:
+        for path in paths:
+            rows_before = count_rows(ds_ids)
+            messages, elapsed, latencies, extra = RUNNERS[path](args, routes)
+            rows = count_rows(ds_ids) - rows_before
+            results.append(report(args, path, len(routes), messages, elapsed, rows, latencies, extra))
+    finally:
+        if not args.keep:
+            drop_fixtures(run_id, ds_ids)
+
+    by_path = {result["path"]: result for result in results}
+    if "http" in by_path and "http-row" in by_path and by_path["http-row"]["db_rows_per_s"]:
+        print(f"CreateObservations / POST Observations: "
+              f"{by_path['http']['db_rows_per_s'] / by_path['http-row']['db_rows_per_s']:.1f}x rows/s")
+    print(json.dumps(results if len(results) > 1 else results[0], indent=2))
+    if args.output:
+        with open(args.output, "a") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            previous = list(map(json.loads, filter(str.strip, f)))
+        failed = False
+        for result in results:
+            same = [r for r in previous
+                    if (r["path"], r["shape"], r["samples"]) == (result["path"], result["shape"], result["samples"])]
+            if same:
+                for regression in compare(result, same[-1], args.tolerance):
+                    print(f"REGRESSION ({result['path']}): {regression}")
+                    failed = True
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
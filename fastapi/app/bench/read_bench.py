@@ -0,0 +1,172 @@
+"""Read concurrency benchmark: sync (threadpool + psycopg2) vs async (asyncpg) routes.
+
+Creates synthetic Datastreams with observations, then keeps --concurrency
+GET requests in flight for --duration seconds against the hot read routes
+(GET /Observations, /Datastreams(id)/Observations, /Datastreams) through the
+ASGI app, and reports req/s and p50/p99 latency.
+
+DB_ASYNC_ENABLED is read when the app is imported, so each mode runs in its
+own process; --mode both runs the two on the same fixtures and prints the
+gain. Set --threads to the threadpool size used in production (Starlette's
+default is 40): sync routes queue behind it, async ones do not.
+
+Examples (from the app directory):
+    python bench/read_bench.py --mode both --concurrency 200 --duration 20
+    python bench/read_bench.py --mode async --concurrency 50 --output results.jsonl
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import subprocess
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MQTT_LISTENER_ENABLED", "false")
+
+from ingest_bench import Clock, create_fixtures, drop_fixtures, percentile
+
+MODES = ("sync", "async")
+
+
+## FIXTURES ___________________________________________________________
+def seed_observations(ds_ids, per_datastream):
+    from database import SessionLocal
+    from ingest_writer import insert_observations
+
+    clock = Clock()
+    session = SessionLocal()
+    try:
+        for ds_id in ds_ids:
+            rows = [
+                {"phenomenonTime": t, "result": round(random.uniform(-10, 40), 3), "datastream_id": ds_id}
+                for t in clock.take(per_datastream)
+            ]
+            insert_observations(session, rows)
+        session.commit()
+    finally:
+        session.close()
+
+
+## REQUESTS ___________________________________________________________
+def request_paths(ds_ids, top):
+    """Mix of hot read requests, drawn at random"""
+    return [
+        *(f"/v1.0/Observations?datastream_id={ds_id}&$top={top}" for ds_id in ds_ids),
+        *(f"/v1.0/Datastreams({ds_id})/Observations?$top={top}" for ds_id in ds_ids),
+        f"/v1.0/Datastreams?$top={top}",
+    ]
+
+
+def run(args, ds_ids):
+    import anyio.to_thread
+    import httpx
+    from main import app
+    from database import DB_ASYNC_ENABLED
+
+    paths = request_paths(ds_ids, args.top)
+    latencies = []
+    errors = 0
+
+    async def worker(client, deadline):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            t0 = time.perf_counter()
+            response = await client.get(random.choice(paths))
+            latencies.append(time.perf_counter() - t0)
+            if response.status_code != 200:
+                errors += 1
+
+    async def main():
+        if args.threads:
+            anyio.to_thread.current_default_thread_limiter().total_tokens = args.threads
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", follow_redirects=True) as client:
+            # Warm up the pools and caches before timing
+            await asyncio.gather(*(client.get(path) for path in paths[:args.concurrency]))
+            deadline = time.perf_counter() + args.duration
+            await asyncio.gather(*(worker(client, deadline) for _ in range(args.concurrency)))
+
+    start = time.perf_counter()
+    asyncio.run(main())
+    elapsed = time.perf_counter() - start
+
+    p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+    return {
+        "mode": "async" if DB_ASYNC_ENABLED else "sync",
+        "concurrency": args.concurrency,
+        "threads": args.threads,
+        "top": args.top,
+        "requests": len(latencies),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "req_per_s": len(latencies) / elapsed,
+        "latency_p50_ms": p50 * 1000 if p50 is not None else None,
+        "latency_p99_ms": p99 * 1000 if p99 is not None else None,
+        "at": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def run_mode(mode, args, ds_ids):
+    """Run one mode in a child process on the given datastreams, return its result"""
+    argv = [
+        "--mode", mode, "--datastreams", ",".join(ds_ids), "--top", str(args.top),
+        "--concurrency", str(args.concurrency), "--duration", str(args.duration), "--seed", str(args.seed),
+    ]
+    if args.threads:
+        argv += ["--threads", str(args.threads)]
+    env = {**os.environ, "DB_ASYNC_ENABLED": "true" if mode == "async" else "false"}
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), *argv],
+        env=env, check=True, stdout=subprocess.PIPE, text=True,
+    ).stdout
+    # The result is the last line, after what the app prints at startup
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=(*MODES, "both"), default="both")
+    parser.add_argument("--datastreams", help="comma-separated ids of existing datastreams (no fixtures)")
+    parser.add_argument("--things", type=int, default=20)
+    parser.add_argument("--properties", type=int, default=2)
+    parser.add_argument("--observations", type=int, default=2000, help="observations per datastream")
+    parser.add_argument("--top", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=100, help="in-flight requests")
+    parser.add_argument("--threads", type=int, default=None, help="threadpool size (default: Starlette's)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="append the results as JSON lines to this file")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    if args.datastreams:
+        print(json.dumps(run(args, args.datastreams.split(","))))
+        return
+
+    run_id = uuid.uuid4().hex[:8]
+    ds_ids = [ds_id for _, ds_id in create_fixtures(run_id, args.things, args.properties)]
+    try:
+        seed_observations(ds_ids, args.observations)
+        modes = MODES if args.mode == "both" else (args.mode,)
+        results = [run_mode(mode, args, ds_ids) for mode in modes]
+    finally:
+        drop_fixtures(run_id, ds_ids)
+
+    if len(results) == 2:
+        sync, async_ = results
+        print(f"async / sync: {async_['req_per_s'] / sync['req_per_s']:.2f}x req/s, "
+              f"p99 {sync['latency_p99_ms']:.1f} ms -> {async_['latency_p99_ms']:.1f} ms")
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "a") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
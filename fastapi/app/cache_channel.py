@@ -0,0 +1,97 @@
+import os
+import time
+import uuid
+import select
+import logging
+import threading
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+
+logger = logging.getLogger(__name__)
+
+# Writes that make the in-process caches (topic routes, metadata responses)
+# stale are broadcast on this channel, so that every process - API workers and
+# ingest replicas - applies them: payload = "<origin>:<cache>:<key>"
+CACHE_CHANNEL = os.getenv("CACHE_CHANNEL", "bdoh_cache")
+# Identifies this process among publishers (pids repeat across containers)
+ORIGIN = uuid.uuid4().hex
+
+# cache name -> handler(key), key None meaning "forget everything"
+_handlers = {}
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def subscribe(cache, handler):
+    """Call handler(key) for the invalidations of `cache` published by any process,
+    and handler(None) whenever some may have been missed (listener (re)connecting)"""
+    _handlers[cache] = handler
+
+
+def publish(db: Session, cache, key=""):
+    """Apply an invalidation in this process and notify the others. Call after
+    the write has been committed."""
+    _apply(cache, key)
+    # On a connection of its own, so the session's objects are not expired by another commit
+    with db.get_bind().connect() as connection:
+        connection.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": CACHE_CHANNEL, "payload": f"{ORIGIN}:{cache}:{key}"},
+        )
+        connection.commit()
+
+
+def _apply(cache, key):
+    handler = _handlers.get(cache)
+    if handler is not None:
+        handler(key)
+
+
+def _dispatch(payload):
+    origin, cache, key = payload.split(":", 2)
+    # Already applied by the process that published it
+    if origin != ORIGIN:
+        _apply(cache, key)
+
+
+def _reset():
+    for handler in list(_handlers.values()):
+        handler(None)
+
+
+def start_listener(engine, retry_delay=5):
+    """LISTEN on CACHE_CHANNEL in a daemon thread, once per process"""
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            _listener = threading.Thread(target=_listen, args=(engine, retry_delay), daemon=True)
+            _listener.start()
+    return _listener
+
+
+def _listen(engine, retry_delay):
+    while True:
+        connection = None
+        try:
+            # Own connection, out of the pool: it stays in LISTEN for the life of the process
+            connection = engine.raw_connection()
+            connection.detach()
+            dbapi = connection.driver_connection
+            dbapi.autocommit = True
+            dbapi.cursor().execute(f'LISTEN "{CACHE_CHANNEL}"')
+            # Invalidations sent while not listening are lost: start over from empty caches
+            _reset()
+            while True:
+                if select.select([dbapi], [], [], 60) == ([], [], []):
+                    continue
+                dbapi.poll()
+                while dbapi.notifies:
+                    _dispatch(dbapi.notifies.pop(0).payload)
+        except Exception as e:
+            logger.warning("Cache invalidation listener disconnected (%s), retrying in %ss", e, retry_delay)
+        finally:
+            if connection is not None:
+                connection.close()
+        _reset()
+        time.sleep(retry_delay)
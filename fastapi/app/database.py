@@ -4,6 +4,9 @@ import time
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.exc import OperationalError
+from starlette.concurrency import run_in_threadpool
+
+from db_pool import pool_options, connect_args, instrument, InstrumentedQueuePool, InstrumentedAsyncPool
 
 POSTGRES_USER = os.getenv("POSTGRES_USER", "iot_user")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "iot_password")
@@ -11,13 +14,38 @@ POSTGRES_DB = os.getenv("POSTGRES_DB", "iot")
 POSTGRES_HOST = os.getenv("POSTGRES_HOST", "timescaledb")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT", "5432")
 
+DB_STARTUP_RETRIES = int(os.getenv("DB_STARTUP_RETRIES", 10))
+# Ingest can start without the database and spool until it is back
+DB_STARTUP_REQUIRED = os.getenv("DB_STARTUP_REQUIRED", "true").lower() == "true"
+# Hot read routes run on an asyncpg engine instead of psycopg2 sessions in the threadpool
+DB_ASYNC_ENABLED = os.getenv("DB_ASYNC_ENABLED", "false").lower() == "true"
+
 SQLALCHEMY_DATABASE_URL = (
     f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}"
     f"@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
 )
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-for i in range(10):
+
+def make_engine(name):
+    """Engine with its own pool, configured by <NAME>_DB_* / DB_* variables (see db_pool)"""
+    options = pool_options(name)
+    engine = create_engine(
+        SQLALCHEMY_DATABASE_URL,
+        poolclass=InstrumentedQueuePool,
+        pool_logging_name=name,
+        connect_args=connect_args(name),
+        **options,
+    )
+    instrument(engine, name, options)
+    return engine
+
+
+# HTTP routes and MQTT ingest have separate pools: a burst on one side cannot
+# take all the connections of the other
+engine = make_engine("api")
+ingest_engine = make_engine("ingest")
+
+for i in range(DB_STARTUP_RETRIES):
     try:
         with engine.connect() as conn:
             print("DB ready!")
@@ -26,10 +54,13 @@ for i in range(10):
         print("Waiting for DB...")
         time.sleep(2)
 else:
-    raise RuntimeError("DB not ready after 10 retries")
+    if DB_STARTUP_REQUIRED:
+        raise RuntimeError(f"DB not ready after {DB_STARTUP_RETRIES} retries")
+    print(f"DB not ready after {DB_STARTUP_RETRIES} retries, starting anyway")
 
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+IngestSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=ingest_engine)
 
 Base = declarative_base()
 
@@ -39,3 +70,69 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+## ASYNC ______________________________________________________________
+# Created only with DB_ASYNC_ENABLED: asyncpg is an optional dependency
+async_engine = None
+AsyncSessionLocal = None
+if DB_ASYNC_ENABLED:
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+    async_options = pool_options("api")
+    async_engine = create_async_engine(
+        SQLALCHEMY_DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1),
+        poolclass=InstrumentedAsyncPool,
+        pool_logging_name="api_async",
+        connect_args=connect_args("api", driver="asyncpg"),
+        **async_options,
+    )
+    instrument(async_engine.sync_engine, "api_async", async_options)
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+class Offload:
+    """Returned by a function given to `run` for the CPU-bound rest of its work
+    (downsampling, encoding): fn(*args) is then called in the threadpool, never
+    on the event loop. It must not use the session."""
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def __call__(self):
+        return self.fn(*self.args)
+
+
+def _finish(result):
+    return result() if isinstance(result, Offload) else result
+
+
+async def get_db_runner():
+    """`run(fn, *args, **kwargs)` calling fn(session, *args, **kwargs) for an async route.
+
+    With DB_ASYNC_ENABLED the function runs through AsyncSession.run_sync: its
+    queries go through asyncpg and no thread is held while PostgreSQL answers,
+    but it runs on the event loop, so what it returns as an Offload is called
+    in the threadpool. Otherwise everything runs in Starlette's threadpool on a
+    psycopg2 session, as the sync routes do. Either way, the same query code
+    serves both paths.
+    """
+    if DB_ASYNC_ENABLED:
+        async with AsyncSessionLocal() as db:
+            async def run(fn, *args, **kwargs):
+                result = await db.run_sync(fn, *args, **kwargs)
+                return await run_in_threadpool(result) if isinstance(result, Offload) else result
+            yield run
+    else:
+        db = SessionLocal()
+        try:
+            yield lambda fn, *args, **kwargs: run_in_threadpool(lambda: _finish(fn(db, *args, **kwargs)))
+        finally:
+            # psycopg2 I/O: not on the event loop
+            await run_in_threadpool(db.close)
@@ -0,0 +1,85 @@
+import os
+import time
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+from metrics import DB_POOL_CHECKOUT_SECONDS, DB_POOL_TIMEOUTS, DB_POOL_CHECKED_OUT, DB_POOL_CAPACITY
+
+
+## POOL SETTINGS ______________________________________________________
+# Each engine reads <NAME>_<SETTING> first (e.g. INGEST_DB_POOL_SIZE), then
+# <SETTING> (DB_POOL_SIZE), then the default below.
+
+def _bool(value):
+    return value.lower() == "true"
+
+
+POOL_SETTINGS = {
+    # setting: (engine keyword, default, type)
+    "DB_POOL_SIZE": ("pool_size", 5, int),
+    "DB_MAX_OVERFLOW": ("max_overflow", 10, int),
+    # Seconds to wait for a connection before failing the request
+    "DB_POOL_TIMEOUT": ("pool_timeout", 30, float),
+    # Connections older than this are replaced (seconds, -1 = never)
+    "DB_POOL_RECYCLE": ("pool_recycle", 1800, int),
+    "DB_POOL_PRE_PING": ("pool_pre_ping", True, _bool),
+}
+
+
+def setting(name, key, default, cast=int):
+    value = os.getenv(f"{name.upper()}_{key}", os.getenv(key))
+    return default if value is None else cast(value)
+
+
+def pool_options(name):
+    """create_engine pool keywords of the engine `name`"""
+    return {
+        keyword: setting(name, key, default, cast)
+        for key, (keyword, default, cast) in POOL_SETTINGS.items()
+    }
+
+
+def connect_args(name, driver="psycopg2"):
+    """Connection arguments: application_name, and statement_timeout when set (ms, 0 = none)"""
+    timeout = setting(name, "DB_STATEMENT_TIMEOUT_MS", 0)
+    if driver == "asyncpg":
+        settings = {"application_name": f"bdoh-{name}"}
+        if timeout:
+            settings["statement_timeout"] = str(timeout)
+        return {"server_settings": settings}
+    args = {"application_name": f"bdoh-{name}"}
+    if timeout:
+        args["options"] = f"-c statement_timeout={timeout}"
+    return args
+
+
+## INSTRUMENTED POOLS _________________________________________________
+class _InstrumentedPool:
+    """Times each checkout, including the wait for a free connection, under
+    the pool_logging_name of its engine"""
+
+    def _do_get(self):
+        name = getattr(self, "logging_name", None) or "default"
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            DB_POOL_TIMEOUTS.labels(name).inc()
+            raise
+        finally:
+            DB_POOL_CHECKOUT_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+
+class InstrumentedQueuePool(_InstrumentedPool, QueuePool):
+    pass
+
+
+class InstrumentedAsyncPool(_InstrumentedPool, AsyncAdaptedQueuePool):
+    pass
+
+
+def instrument(engine, name, options):
+    """Saturation gauges of an engine's pool, read at scrape time: connections
+    checked out, against pool_size + max_overflow"""
+    DB_POOL_CHECKED_OUT.labels(name).set_function(lambda: engine.pool.checkedout())
+    DB_POOL_CAPACITY.labels(name).set(options["pool_size"] + options["max_overflow"])
@@ -0,0 +1,48 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+
+INGEST_DEDUP_SIZE = int(os.getenv("INGEST_DEDUP_SIZE", 100000))
+INGEST_DEDUP_TTL = float(os.getenv("INGEST_DEDUP_TTL", 300))
+
+
+## DEDUP WINDOW _______________________________________________________
+class DedupWindow:
+    """Recently seen keys, bounded in number and age.
+
+    Catches QoS 1 redeliveries and devices re-publishing the same reading
+    before they reach the database. A size of 0 disables it.
+    """
+
+    def __init__(self, max_size=INGEST_DEDUP_SIZE, ttl=INGEST_DEDUP_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.duplicates = 0
+
+        self._seen = OrderedDict()  # key -> expires_at
+        self._lock = threading.Lock()
+
+    def seen(self, key):
+        """Record `key`, True if it was already seen within the window"""
+        if self.max_size <= 0:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            # Oldest entries first: drop the expired ones
+            while self._seen:
+                oldest, expires_at = next(iter(self._seen.items()))
+                if expires_at > now:
+                    break
+                del self._seen[oldest]
+            if key in self._seen:
+                self.duplicates += 1
+                return True
+            self._seen[key] = now + self.ttl
+            if len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+            return False
+
+    def __len__(self):
+        return len(self._seen)
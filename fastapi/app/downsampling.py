@@ -0,0 +1,133 @@
+from datetime import datetime, timezone
+import numpy as np
+from fastapi import HTTPException
+from sqlalchemy import Float, cast, func, select
+from sqlalchemy.orm import Session
+
+from models import Observation
+from odata_filter import filter_condition
+
+
+DOWNSAMPLE_METHODS = ("lttb", "minmax")
+
+# Rows fetched per round trip while reading the series (server-side cursor)
+DOWNSAMPLE_CHUNK_SIZE = 50000
+
+
+## SERIES READ ________________________________________________________
+def read_series(db: Session, datastream_id, time_start=None, time_end=None, filter_text=None):
+    """(epoch seconds, result) float64 arrays of a datastream in [time_start, time_end),
+    ordered by time, restricted by a $filter if any.
+
+    Rows are streamed in chunks straight into NumPy, no Observation object is built.
+    """
+    stmt = select(
+        cast(func.extract("epoch", Observation.phenomenonTime), Float),
+        Observation.result,
+    ).where(Observation.datastream_id == datastream_id)
+    if time_start:
+        stmt = stmt.where(Observation.phenomenonTime >= time_start)
+    # Half-open like the aggregation route: the same window gives the same observations
+    if time_end:
+        stmt = stmt.where(Observation.phenomenonTime < time_end)
+    if filter_text:
+        stmt = stmt.where(filter_condition(Observation, filter_text))
+    stmt = stmt.order_by(Observation.phenomenonTime)
+
+    result = db.execute(stmt.execution_options(stream_results=True, yield_per=DOWNSAMPLE_CHUNK_SIZE))
+    chunks = [np.array(part, dtype=np.float64) for part in result.partitions()]
+    if not chunks:
+        return np.empty(0), np.empty(0)
+    series = np.concatenate(chunks)
+    return series[:, 0], series[:, 1]
+
+
+## DOWNSAMPLING _______________________________________________________
+def lttb(x, y, n_out):
+    """Indices kept by Largest-Triangle-Three-Buckets.
+
+    First and last points are kept, the others are split into n_out - 2 buckets
+    of equal count; in each bucket the point forming the largest triangle with
+    the previously kept point and the average of the next bucket is kept.
+    """
+    n = len(x)
+    if n <= n_out:
+        return np.arange(n)
+    if n_out < 3:
+        return np.array([0, n - 1])[:n_out]
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    widths = np.diff(edges)
+    # Average point of each bucket, the last point standing for the bucket after the last one
+    avg_x = np.append(np.add.reduceat(x[:n - 1], edges[:-1]) / widths, x[-1])
+    avg_y = np.append(np.add.reduceat(y[:n - 1], edges[:-1]) / widths, y[-1])
+
+    kept = np.empty(n_out, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        cx, cy = avg_x[i + 1], avg_y[i + 1]
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        kept[i + 1] = a
+    return kept
+
+
+def minmax(x, y, n_out):
+    """Indices of the minimum and maximum of each of (n_out - 2) // 2 equal time buckets
+    (pixel columns), plus the first and last points"""
+    n = len(x)
+    if n <= n_out:
+        return np.arange(n)
+    if n_out < 3:
+        return np.array([0, n - 1])[:n_out]
+    if n_out == 3:
+        # No room for a min / max pair: the point furthest from the mean stands for the range
+        return np.unique([0, int(np.argmax(np.abs(y - y.mean()))), n - 1])
+    buckets = max((n_out - 2) // 2, 1)
+    span = x[-1] - x[0]
+    column = np.zeros(n, dtype=np.int64) if span <= 0 else \
+        np.minimum(((x - x[0]) / span * buckets).astype(np.int64), buckets - 1)
+
+    # x is sorted, so every bucket is a contiguous run
+    starts = np.flatnonzero(np.r_[True, column[1:] != column[:-1]])
+    run = np.cumsum(np.r_[False, column[1:] != column[:-1]])
+    lows = np.minimum.reduceat(y, starts)
+    highs = np.maximum.reduceat(y, starts)
+    # First index reaching the bucket minimum / maximum
+    is_low = np.flatnonzero(y == lows[run])
+    is_high = np.flatnonzero(y == highs[run])
+    low_idx = is_low[np.unique(run[is_low], return_index=True)[1]]
+    high_idx = is_high[np.unique(run[is_high], return_index=True)[1]]
+    return np.unique(np.concatenate(([0, n - 1], low_idx, high_idx)))
+
+
+def check_method(method):
+    if method not in DOWNSAMPLE_METHODS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown downsample method {method!r}, expected one of {list(DOWNSAMPLE_METHODS)}"
+        )
+
+
+def downsample_series(x, y, max_points, method="lttb"):
+    """At most max_points points of a series read by read_series, preserving its shape.
+
+    Returns (number of observations in the series, list of {phenomenonTime, result}) in time order.
+    CPU only: no database access, so it can run off the event loop.
+    """
+    check_method(method)
+    kept = (lttb if method == "lttb" else minmax)(x, y, max_points)
+    return len(x), [
+        {"phenomenonTime": datetime.fromtimestamp(t, timezone.utc), "result": v}
+        for t, v in zip(x[kept].tolist(), y[kept].tolist())
+    ]
+
+
+def downsample_observations(db: Session, datastream_id, max_points, method="lttb", time_start=None, time_end=None,
+                            filter_text=None):
+    """downsample_series of the datastream's observations in the range"""
+    check_method(method)
+    x, y = read_series(db, datastream_id, time_start, time_end, filter_text)
+    return downsample_series(x, y, max_points, method)
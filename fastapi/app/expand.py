@@ -0,0 +1,256 @@
+import os
+from collections import namedtuple
+from functools import lru_cache
+from fastapi import HTTPException
+from sqlalchemy import func, select
+from sqlalchemy.orm import aliased, selectinload, load_only
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import Observation
+from odata_filter import NAVIGATION, filter_condition
+from serialization import entities, select_columns
+
+
+# Default $top of an expanded collection
+EXPAND_TOP = int(os.getenv("EXPAND_TOP", 100))
+
+
+## $EXPAND PARSING ____________________________________________________
+class ExpandNode(namedtuple("ExpandNode", ["top", "skip", "select", "filter", "orderby", "expand"])):
+    """One expanded navigation property, with its options and its own nested $expand"""
+
+    def window(self, items):
+        """Page of an expanded collection: $orderby, then $skip / $top"""
+        if items and hasattr(items[0], "phenomenonTime"):
+            items = sorted(items, key=lambda item: item.phenomenonTime, reverse=True)
+        else:
+            items = sorted(items, key=lambda item: item.id)
+        if self.orderby and items:
+            key = order_key(type(items[0]), self.orderby[0])
+            # NULLs last ascending, first descending, as in PostgreSQL
+            items = sorted(
+                items, key=lambda item: (getattr(item, key) is None, getattr(item, key)), reverse=self.orderby[1]
+            )
+        return items[self.skip:self.skip + self.top]
+
+    def columns(self, model):
+        """Columns to load for the $select of this node, with the $orderby one"""
+        select = self.select
+        if self.orderby:
+            select = select | {self.orderby[0]}
+        return select_columns(model, select)
+
+
+def _split(text, separator):
+    """Split on separator outside parentheses"""
+    parts, depth, start = [], 0, 0
+    for i, c in enumerate(text):
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if depth < 0:
+                raise ValueError("Unbalanced parentheses")
+        elif c == separator and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    if depth:
+        raise ValueError("Unbalanced parentheses")
+    parts.append(text[start:])
+    return [part.strip() for part in parts if part.strip()]
+
+
+def _options(text):
+    options = {"top": EXPAND_TOP, "skip": 0, "select": None, "filter": None, "orderby": None, "expand": {}}
+    for option in _split(text, ";"):
+        name, _, value = option.partition("=")
+        name = name.strip().lower()
+        value = value.strip()
+        if name == "$top":
+            options["top"] = int(value)
+        elif name == "$skip":
+            options["skip"] = int(value)
+        elif name == "$select":
+            options["select"] = frozenset(v.strip() for v in value.split(","))
+        elif name == "$filter":
+            options["filter"] = value
+        elif name == "$orderby":
+            prop, _, direction = value.partition(" ")
+            options["orderby"] = (prop, direction.strip().lower() == "desc")
+        elif name == "$expand":
+            options["expand"] = _parse_expand(value)
+        else:
+            raise ValueError(f"Unsupported $expand option {name!r}")
+    return options
+
+
+def _parse_expand(text):
+    tree = {}
+    for item in _split(text, ","):
+        level = tree
+        for segment in _split(item, "/"):
+            name, options = segment, None
+            if segment.endswith(")"):
+                name, _, options = segment[:-1].partition("(")
+                name = name.strip()
+            node = level.get(name)
+            if node is None or options is not None:
+                fields = _options(options or "")
+                if node is not None:
+                    # Same property expanded twice: keep the children of both
+                    fields["expand"] = {**node.expand, **fields["expand"]}
+                node = ExpandNode(**fields)
+                level[name] = node
+            level = node.expand
+    return tree
+
+
+@lru_cache(maxsize=256)
+def parse_expand(text):
+    """{navigation property: ExpandNode} of a $expand, e.g. "Datastreams($top=5)/Sensor,Locations".
+
+    Cached by $expand string: the tree is shared, never modify it.
+    """
+    return _parse_expand(text)
+
+
+## BATCHED LOADING ____________________________________________________
+# Each expanded navigation property costs one query for the whole page,
+# whatever the number of rows: selectinload for the metadata entities, and a
+# ROW_NUMBER() window for Observations, so that only $top rows per parent are read.
+
+def _target(model, name):
+    try:
+        return NAVIGATION[model][name][0]
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"{model.__name__} has no navigation property {name!r}")
+
+
+def order_key(model, name):
+    """Mapped attribute of an $orderby property (by attribute or column name)"""
+    for prop in model.__mapper__.column_attrs:
+        if name in (prop.key, prop.columns[0].name):
+            return prop.key
+    raise HTTPException(status_code=400, detail=f"Unknown $orderby property of {model.__name__}: {name!r}")
+
+
+def check_tree(model, tree):
+    """400 on a navigation property or $orderby unknown to its model, before any query"""
+    for name, node in tree.items():
+        target = _target(model, name)
+        if node.orderby:
+            order_key(target, node.orderby[0])
+        check_tree(target, node.expand)
+
+
+def _windowed(model, name):
+    # Observations collections: too large to be loaded whole
+    return _target(model, name) is Observation and name == "Observations"
+
+
+def loader_options(model, tree):
+    """selectinload options for the expand tree, down to any Observations collection"""
+    options = []
+    for name, node in tree.items():
+        target = _target(model, name)
+        if _windowed(model, name):
+            continue
+        attribute = getattr(model, name)
+        if node.filter:
+            attribute = attribute.and_(filter_condition(target, node.filter))
+        nested = loader_options(target, node.expand)
+        if node.select:
+            nested.append(load_only(*node.columns(target)))
+        options.append(selectinload(attribute).options(*nested))
+    return options
+
+
+def _load_observations(db, rows, model, name, node):
+    """At most $skip + $top Observations per row, in one query"""
+    _, local, remote, _ = NAVIGATION[model][name]
+    keys = {getattr(row, local.key) for row in rows}
+    loaded = {key: [] for key in keys}
+    if keys:
+        # $orderby first, newest first between equal values
+        order_by = [Observation.phenomenonTime.desc()]
+        if node.orderby:
+            key = order_key(Observation, node.orderby[0])
+            column = getattr(Observation, key)
+            order_by = [column.desc() if node.orderby[1] else column.asc()] + \
+                (order_by if key != "phenomenonTime" else [])
+        rank = func.row_number().over(partition_by=remote, order_by=order_by).label("rank")
+        stmt = select(Observation, rank).where(remote.in_(keys))
+        if node.filter:
+            stmt = stmt.where(filter_condition(Observation, node.filter))
+        ranked = stmt.subquery()
+        observation = aliased(Observation, ranked)
+        query = db.query(observation).filter(ranked.c.rank <= node.skip + node.top)
+        if node.select:
+            query = query.options(load_only(
+                *[getattr(observation, c.key) for c in node.columns(Observation)]
+            ))
+        for obs in query:
+            loaded[getattr(obs, remote.key)].append(obs)
+    for row in rows:
+        set_committed_value(row, name, loaded[getattr(row, local.key)])
+
+
+def _load_related(db, rows, model, name, node):
+    """Many-to-one navigation (e.g. Observation/Datastream) of rows loaded by hand, in one query"""
+    target, local, remote, _ = NAVIGATION[model][name]
+    keys = {getattr(row, local.key) for row in rows} - {None}
+    query = db.query(target).filter(remote.in_(keys)) if node.filter is None else \
+        db.query(target).filter(remote.in_(keys), filter_condition(target, node.filter))
+    query = query.options(*loader_options(target, node.expand))
+    if node.select:
+        query = query.options(load_only(*node.columns(target)))
+    related = {getattr(r, remote.key): r for r in query} if keys else {}
+    for row in rows:
+        set_committed_value(row, name, related.get(getattr(row, local.key)))
+
+
+def expand_rows(db, rows, model, tree, loaded=True):
+    """Load what loader_options could not: Observations collections and what hangs below them.
+
+    `loaded` tells whether the navigation properties of `rows` were already
+    selectin-loaded with the query that returned them.
+    """
+    for name, node in tree.items():
+        target = _target(model, name)
+        if _windowed(model, name):
+            _load_observations(db, rows, model, name, node)
+            children = [child for row in rows for child in getattr(row, name)]
+            expand_rows(db, children, target, node.expand, loaded=False)
+            continue
+        if not loaded:
+            _load_related(db, rows, model, name, node)
+        children = []
+        for row in rows:
+            related = getattr(row, name)
+            if isinstance(related, list):
+                children.extend(related)
+            elif related is not None:
+                children.append(related)
+        expand_rows(db, children, target, node.expand)
+
+
+def expand_query(query, model, text):
+    """(query with its loader options, expand tree), 400 on an invalid $expand"""
+    if not text:
+        return query, None
+    try:
+        tree = parse_expand(text)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid $expand: {e}")
+    check_tree(model, tree)
+    return query.options(*loader_options(model, tree)), tree
+
+
+def expand_page(db, rows, model, tree, select=None):
+    """Rows as entity dicts with their $select properties and expanded navigation
+    properties, unchanged without $expand nor $select"""
+    if tree is None and select is None:
+        return rows
+    if tree is not None:
+        expand_rows(db, rows, model, tree)
+    return entities(rows, select, tree)
@@ -0,0 +1,257 @@
+import io
+import os
+import csv
+import json
+from datetime import datetime
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+
+from database import SessionLocal
+from models import Observation
+from odata_filter import filter_condition
+from pagination import after_cursor
+from serialization import parse_select
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Arrow / Parquet responses are optional
+    pa = None
+
+
+# Rows fetched per round trip from the server-side cursor, and written per chunk
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 10000))
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+COLUMNAR_FORMATS = ("arrow", "parquet")
+
+# Accept header media types, besides those of EXPORT_FORMATS
+ACCEPT_ALIASES = {
+    "application/x-parquet": "parquet",
+}
+# Media types answered with the usual JSON collection
+JSON_MEDIA_TYPES = ("application/json", "application/*", "*/*")
+
+EXPORT_COLUMNS = [
+    Observation.phenomenonTime,
+    Observation.resultTime,
+    Observation.result,
+    Observation.resultQuality,
+    Observation.parameters,
+    Observation.datastream_id,
+    Observation.feature_of_interest_id,
+]
+EXPORT_FIELDS = [c.key for c in EXPORT_COLUMNS]
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _ndjson(rows, fields):
+    return "".join(
+        json.dumps(dict(zip(fields, row)), default=_json_default) + "\n" for row in rows
+    )
+
+
+def _csv(rows, fields=None):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([
+            v.isoformat() if isinstance(v, datetime)
+            else json.dumps(v) if isinstance(v, (dict, list))
+            else v
+            for v in row
+        ])
+    return buffer.getvalue()
+
+
+## ARROW / PARQUET ___________________________________________________
+def arrow_schema(fields=EXPORT_FIELDS):
+    schema = pa.schema([
+        ("phenomenonTime", pa.timestamp("us", tz="UTC")),
+        ("resultTime", pa.timestamp("us", tz="UTC")),
+        ("result", pa.float64()),
+        # JSONB columns as JSON text, null when absent
+        ("resultQuality", pa.string()),
+        ("parameters", pa.string()),
+        ("datastream_id", pa.string()),
+        ("feature_of_interest_id", pa.string()),
+    ])
+    return pa.schema([schema.field(name) for name in fields])
+
+
+def _record_batch(rows, schema):
+    """Column-wise record batch from a chunk of database rows"""
+    columns = list(zip(*rows)) if rows else [()] * len(schema)
+    arrays = []
+    for field, values in zip(schema, columns):
+        if field.name in ("resultQuality", "parameters"):
+            values = [None if v is None else json.dumps(v) for v in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class _ChunkSink:
+    """Write-only file collecting what the Arrow / Parquet writers produce, taken after each batch"""
+
+    def __init__(self):
+        self._parts = []
+        self.closed = False
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def _columnar(fmt, fields, partitions):
+    schema = arrow_schema(fields)
+    sink = _ChunkSink()
+    target = pa.PythonFile(sink, mode="w")
+    # Arrow IPC stream: one message per batch, readable as it arrives.
+    # Parquet: one row group per batch, the footer comes last.
+    writer = pa.ipc.new_stream(target, schema) if fmt == "arrow" else pq.ParquetWriter(target, schema)
+    for rows in partitions:
+        if fmt == "arrow":
+            writer.write_batch(_record_batch(rows, schema))
+        else:
+            writer.write_table(pa.Table.from_batches([_record_batch(rows, schema)]))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+## STREAMING EXPORT ___________________________________________________
+def _partitions(columns, conditions, order, top=None, skip=0):
+    # Own session: the request one is closed before the body is streamed
+    session = SessionLocal()
+    try:
+        stmt = select(*columns).where(*conditions).order_by(*order)
+        if skip:
+            stmt = stmt.offset(skip)
+        if top is not None:
+            stmt = stmt.limit(top)
+        result = session.execute(stmt.execution_options(stream_results=True, yield_per=EXPORT_CHUNK_SIZE))
+        yield from result.partitions()
+    finally:
+        session.close()
+
+
+def _stream(fmt, columns, partitions):
+    fields = [c.key for c in columns]
+    if fmt in COLUMNAR_FORMATS:
+        yield from _columnar(fmt, fields, partitions)
+        return
+    if fmt == "csv":
+        yield _csv([fields]).encode()
+    encode = _csv if fmt == "csv" else _ndjson
+    for rows in partitions:
+        yield encode(rows, fields).encode()
+
+
+def accepted_media_types(header):
+    """Media types of an Accept header, most preferred first: by q-value, then
+    exact types before wildcards, then in header order. q=0 ones are left out."""
+    ranked = []
+    for position, item in enumerate(header.split(",")):
+        media_type, *params = [part.strip().lower() for part in item.split(";")]
+        if not media_type:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            ranked.append((-q, "*" in media_type, position, media_type))
+    return [media_type for *_, media_type in sorted(ranked)]
+
+
+def negotiate(request):
+    """Export format asked for by the Accept header, None for the usual JSON
+    collection, also when JSON ranks higher than the export formats"""
+    for media_type in accepted_media_types(request.headers.get("accept", "")):
+        if media_type in JSON_MEDIA_TYPES:
+            return None
+        fmt = ACCEPT_ALIASES.get(media_type)
+        if fmt is None:
+            fmt = next((f for f, t in EXPORT_FORMATS.items() if t == media_type), None)
+        if fmt is not None:
+            return fmt
+    return None
+
+
+def export_observations(fmt="ndjson", datastream_id=None, time_start=None, time_end=None,
+                        filename="observations", feature_of_interest_id=None, filter_text=None,
+                        select_text=None, top=None, skip=0, skiptoken=None, keys=None, descending=False):
+    """Observations streamed as NDJSON, CSV, Arrow IPC or Parquet, in time order,
+    with flat memory whatever the range.
+
+    With `top`, only the page the JSON collection would return is streamed:
+    rows ordered by `keys`, after `skiptoken` or `skip` rows.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown export format {fmt!r}, expected one of {list(EXPORT_FORMATS)}"
+        )
+    if fmt in COLUMNAR_FORMATS and pa is None:
+        raise HTTPException(status_code=406, detail=f"{fmt} responses need pyarrow, which is not installed")
+    # $select: only the requested columns are read (and decompressed) and written
+    columns = EXPORT_COLUMNS
+    if select_text:
+        select = parse_select(select_text)
+        columns = [c for c in EXPORT_COLUMNS if c.key in select]
+        unknown = select - set(EXPORT_FIELDS) - {"@iot.id"}
+        if unknown or not columns:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown $select properties {sorted(unknown)}, expected some of {EXPORT_FIELDS}"
+            )
+
+    conditions = []
+    if datastream_id:
+        conditions.append(Observation.datastream_id == datastream_id)
+    if feature_of_interest_id:
+        conditions.append(Observation.feature_of_interest_id == feature_of_interest_id)
+    if time_start:
+        conditions.append(Observation.phenomenonTime >= time_start)
+    if time_end:
+        conditions.append(Observation.phenomenonTime <= time_end)
+    if filter_text:
+        conditions.append(filter_condition(Observation, filter_text))
+
+    keys = keys or [Observation.phenomenonTime, Observation.datastream_id]
+    if skiptoken:
+        conditions.append(after_cursor(keys, skiptoken, descending))
+        skip = 0
+    order = [k.desc() if descending else k.asc() for k in keys]
+
+    return StreamingResponse(
+        _stream(fmt, columns, _partitions(columns, conditions, order, top, skip)),
+        media_type=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'},
+    )
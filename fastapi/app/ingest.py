@@ -0,0 +1,40 @@
+# Standalone MQTT ingest service, without the HTTP API.
+# Run N of them with the same MQTT_SHARED_GROUP to spread topics over N processes:
+#   MQTT_SHARED_GROUP=ingest python ingest.py
+import os
+import signal
+import logging
+from prometheus_client import start_http_server
+
+import mqtt_listener
+
+
+INGEST_METRICS_PORT = int(os.getenv("INGEST_METRICS_PORT", 9100))
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def shutdown(signum, frame):
+    logger.info("Received signal %s, stopping ingest", signum)
+    if mqtt_listener.client is not None:
+        mqtt_listener.client.disconnect()
+
+
+def main():
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    # Prometheus metrics of this process on http://<host>:INGEST_METRICS_PORT/metrics
+    start_http_server(INGEST_METRICS_PORT)
+    logger.info("Starting ingest, subscription %s", mqtt_listener.subscription())
+    try:
+        # Returns once shutdown() disconnected the client
+        mqtt_listener.start()
+    finally:
+        mqtt_listener.stop()
+        logger.info("Ingest stopped, buffered observations flushed: %s", mqtt_listener.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import os
+import time
+import queue
+import logging
+import threading
+from collections import namedtuple
+
+from ingest_writer import ObservationBatchWriter
+from spool import Spool, SpoolFull
+from metrics import INGEST_STAGE_SECONDS, INGEST_QUEUE_EVENTS, INGEST_QUEUE_DEPTH
+
+
+logger = logging.getLogger(__name__)
+
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 10000))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 2))
+# What to do when the queue is full: block | drop_oldest | spill
+INGEST_OVERFLOW_POLICY = os.getenv("INGEST_OVERFLOW_POLICY", "block")
+
+OVERFLOW_POLICIES = ("block", "drop_oldest", "spill")
+
+# Decoded message, with all its observations, waiting for a writer worker
+IngestMessage = namedtuple("IngestMessage", ["thing_id", "observed_property", "samples", "enqueued_at"])
+
+_STOP = object()
+
+
+## INGEST POOL ________________________________________________________
+class IngestPool:
+    """Bounded queue between the MQTT network thread and a pool of writer workers.
+
+    Each worker owns an ObservationBatchWriter and calls `handler(item, writer)`
+    for every queued message, so database work never runs in the paho thread.
+    Writers fall back to `spool` when the database is unavailable. With the
+    spill policy, `spill` holds messages the queue had no room for and feeds
+    them back into the queue.
+    """
+
+    def __init__(
+        self,
+        handler,
+        workers=INGEST_WORKERS,
+        maxsize=INGEST_QUEUE_SIZE,
+        policy=INGEST_OVERFLOW_POLICY,
+        spool=None,
+        spill_dir=None,
+    ):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}, expected one of {OVERFLOW_POLICIES}")
+        self.handler = handler
+        self.workers = workers
+        self.policy = policy
+        self.spool = spool
+        self.spill = None
+        if policy == "spill":
+            if spill_dir is None:
+                raise ValueError("The spill policy needs a spill_dir")
+            self.spill = Spool(spill_dir, sink=self._requeue)
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        INGEST_QUEUE_DEPTH.set_function(self._queue.qsize)
+        self._threads = []
+        self._counters_lock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"ingest-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        for spool in (self.spool, self.spill):
+            if spool is not None:
+                spool.start()
+
+    def submit(self, thing_id, observed_property, samples):
+        item = IngestMessage(thing_id, observed_property, samples, time.monotonic())
+        if self.policy == "block":
+            self._queue.put(item)
+        elif self.policy == "drop_oldest":
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                        self._count("dropped")
+                    except queue.Empty:
+                        pass
+        else:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self._spill(item)
+                return
+        self._count("enqueued")
+
+    def stop(self):
+        """Let the workers drain the queue, flush their last batch and exit"""
+        # The spill replayer feeds the workers, stop it while they still run
+        if self.spill is not None:
+            self.spill.stop()
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self.spool is not None:
+            self.spool.stop()
+
+    def stats(self):
+        return {
+            "policy": self.policy,
+            "workers": len(self._threads),
+            "depth": self._queue.qsize(),
+            "maxsize": self._queue.maxsize,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "spool_pending": self.spool is not None and self.spool.pending(),
+        }
+
+    def _count(self, name):
+        with self._counters_lock:
+            setattr(self, name, getattr(self, name) + 1)
+        INGEST_QUEUE_EVENTS.labels(name).inc()
+
+    def _spill(self, item):
+        # Kept on disk and queued again later, instead of blocking the network thread
+        record = {
+            "thing_id": item.thing_id,
+            "observed_property": item.observed_property,
+            "samples": item.samples,
+        }
+        try:
+            self.spill.append([record])
+            self._count("spilled")
+        except SpoolFull as e:
+            self._count("dropped")
+            logger.error("Dropped message for %s/%s: %s", item.thing_id, item.observed_property, e)
+
+    def _requeue(self, records):
+        for record in records:
+            self._queue.put(IngestMessage(
+                record["thing_id"], record["observed_property"], record["samples"], time.monotonic()
+            ))
+
+    def _work(self):
+        writer = ObservationBatchWriter(spool=self.spool)
+        tick = max(writer.flush_interval / 4, 0.01)
+        while True:
+            try:
+                item = self._queue.get(timeout=tick)
+            except queue.Empty:
+                writer.flush_if_due()
+                continue
+            if item is _STOP:
+                break
+            INGEST_STAGE_SECONDS.labels("queue_wait").observe(time.monotonic() - item.enqueued_at)
+            try:
+                self.handler(item, writer)
+            except Exception:
+                logger.exception("Failed to handle message for %s/%s", item.thing_id, item.observed_property)
+            writer.flush_if_due()
+        writer.flush()
@@ -0,0 +1,321 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timezone
+from sqlalchemy.exc import IntegrityError, DataError
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from models import Observation
+from latest import as_utc, upsert_latest, latest_cache
+from topic_cache import topic_cache
+from database import IngestSessionLocal
+from spool import SpoolFull, RETRYABLE_ERRORS
+from metrics import INGEST_STAGE_SECONDS, INGEST_OBSERVATIONS, INGEST_BATCH_ROWS, log_sampled
+
+
+logger = logging.getLogger(__name__)
+
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 500))
+INGEST_FLUSH_INTERVAL_MS = int(os.getenv("INGEST_FLUSH_INTERVAL_MS", 1000))
+# An observation already stored for (phenomenonTime, datastream_id) is kept (ignore) or replaced (overwrite)
+OBSERVATION_ON_CONFLICT = os.getenv("OBSERVATION_ON_CONFLICT", "ignore")
+
+ON_CONFLICT_MODES = ("ignore", "overwrite")
+
+# Errors caused by the rows themselves, not by the database being unavailable
+ROW_ERRORS = (IntegrityError, DataError)
+# SQLSTATE of a foreign key violation: the row's datastream no longer exists
+FOREIGN_KEY_VIOLATION = "23503"
+
+# Every row sent in one executemany must carry the same keys
+OBSERVATION_COLUMNS = (
+    "phenomenonTime",
+    "resultTime",
+    "result",
+    "resultQuality",
+    "parameters",
+    "datastream_id",
+    "feature_of_interest_id",
+    "raw",
+)
+
+
+def parse_time(value):
+    """ISO 8601 string, epoch seconds or datetime to an aware datetime (naive
+    ones are UTC), other values unchanged"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.fromtimestamp(value, tz=timezone.utc)
+    return as_utc(value)
+
+
+def observation_row(datastream_id, payload):
+    """Build an insertable observations row from a decoded MQTT payload"""
+    return {
+        "phenomenonTime": parse_time(payload.get("phenomenonTime")) or datetime.now(timezone.utc),
+        "resultTime": parse_time(payload.get("resultTime")),
+        "result": payload["result"],
+        "resultQuality": payload.get("resultQuality"),
+        "parameters": payload.get("parameters", {}),
+        "datastream_id": datastream_id,
+        "feature_of_interest_id": payload.get("feature_of_interest_id"),
+        "raw": payload.get("raw"),
+    }
+
+
+def check_row(row):
+    """Why an observation row cannot be inserted, None when it can"""
+    if not row.get("datastream_id"):
+        return "no datastream_id"
+    result = row.get("result")
+    if not isinstance(result, (int, float)) or isinstance(result, bool):
+        return f"result {result!r} is not a number"
+    if not isinstance(row.get("phenomenonTime"), datetime):
+        return f"phenomenonTime {row.get('phenomenonTime')!r} is not a datetime"
+    if row.get("resultTime") is not None and not isinstance(row["resultTime"], datetime):
+        return f"resultTime {row['resultTime']!r} is not a datetime"
+    return None
+
+
+def insert_observations(session: Session, rows, on_conflict=OBSERVATION_ON_CONFLICT, returning=False):
+    """Multi-row INSERT of observation rows, without committing.
+
+    Rows whose (phenomenonTime, datastream_id) already exists are skipped or
+    overwritten according to `on_conflict`, instead of failing the whole
+    transaction. With `returning`, the keys of the rows written are returned.
+    latest_observations is moved forward in the same transaction.
+    """
+    if on_conflict not in ON_CONFLICT_MODES:
+        raise ValueError(f"Unknown on_conflict mode {on_conflict!r}, expected one of {ON_CONFLICT_MODES}")
+    if not rows:
+        return set() if returning else None
+
+    # A statement may not update the same row twice: the last duplicate wins
+    unique = {}
+    for row in rows:
+        unique[(parse_time(row.get("phenomenonTime")), row.get("datastream_id"))] = row
+    # Parsed times, so that naive ones are stored as UTC whatever the session TimeZone
+    normalized = [
+        {**{col: row.get(col) for col in OBSERVATION_COLUMNS},
+         "phenomenonTime": time, "resultTime": parse_time(row.get("resultTime"))}
+        for (time, _), row in unique.items()
+    ]
+
+    table = Observation.__table__
+    stmt = insert(table)
+    key = [table.c.phenomenonTime, table.c.datastream_id]
+    if on_conflict == "overwrite":
+        stmt = stmt.on_conflict_do_update(
+            index_elements=key,
+            set_={col: stmt.excluded[col] for col in OBSERVATION_COLUMNS
+                  if col not in ("phenomenonTime", "datastream_id")}
+        )
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=key)
+
+    if not returning:
+        session.execute(stmt, normalized)
+        written = None
+    else:
+        result = session.execute(stmt.returning(*key), normalized)
+        written = {(r.phenomenonTime, r.datastream_id) for r in result}
+
+    upsert_latest(
+        session,
+        [{**row, "phenomenonTime": time} for (time, _), row in unique.items()],
+        replace_same_time=on_conflict == "overwrite",
+    )
+    return written
+
+
+def parsed_times(rows):
+    """Rows with phenomenonTime / resultTime as datetimes (spooled rows hold strings)"""
+    return [
+        {**row, "phenomenonTime": parse_time(row.get("phenomenonTime")), "resultTime": parse_time(row.get("resultTime"))}
+        for row in rows
+    ]
+
+
+def written_rows(rows, written):
+    """Rows, times parsed, whose (phenomenonTime, datastream_id) is in the keys returned by insert_observations"""
+    return [
+        row for row in parsed_times(rows)
+        if (row["phenomenonTime"], row.get("datastream_id")) in written
+    ]
+
+
+def write_observations(rows, session_factory=IngestSessionLocal):
+    """Insert and commit observation rows in one transaction"""
+    session: Session = session_factory()
+    try:
+        with INGEST_STAGE_SECONDS.labels("insert").time():
+            written = insert_observations(session, rows, returning=True)
+        with INGEST_STAGE_SECONDS.labels("commit").time():
+            session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    latest_cache.update(written_rows(rows, written))
+
+
+def write_observation_batch(rows, session_factory=IngestSessionLocal):
+    """write_observations, bisecting a batch the database refuses because of
+    its rows (constraint violation, invalid value) down to the rows at fault,
+    so that one bad observation does not take the others of its batch with it.
+    Returns the rejected rows."""
+    try:
+        write_observations(rows, session_factory)
+        return []
+    except ROW_ERRORS as e:
+        if len(rows) == 1:
+            if getattr(e.orig, "pgcode", None) == FOREIGN_KEY_VIOLATION:
+                # Datastream deleted while its topic was still cached
+                topic_cache.invalidate_datastream(rows[0].get("datastream_id"))
+            logger.error("Rejected observation %s: %s", rows[0], e.orig)
+            return rows
+    middle = len(rows) // 2
+    return (write_observation_batch(rows[:middle], session_factory)
+            + write_observation_batch(rows[middle:], session_factory))
+
+
+## BATCH WRITER _______________________________________________________
+class ObservationBatchWriter:
+    """Buffer observation rows and write them one batch per transaction.
+
+    A batch is flushed when it reaches `batch_size` rows or when its oldest
+    row is `flush_interval_ms` old, whichever comes first. With a `spool`,
+    batches the database cannot take are appended to it instead of being lost,
+    and new batches go to the spool too until it has been replayed.
+    """
+
+    def __init__(
+        self,
+        batch_size=INGEST_BATCH_SIZE,
+        flush_interval_ms=INGEST_FLUSH_INTERVAL_MS,
+        session_factory=IngestSessionLocal,
+        spool=None,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.session_factory = session_factory
+        self.spool = spool
+
+        self._buffer = []
+        self._first_added = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the background thread that flushes on the time limit"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def add(self, row):
+        if not self._checked([row]):
+            return
+        with self._lock:
+            if not self._buffer:
+                self._first_added = time.monotonic()
+            self._buffer.append(row)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def add_many(self, rows):
+        rows = self._checked(rows)
+        if not rows:
+            return
+        with self._lock:
+            if not self._buffer:
+                self._first_added = time.monotonic()
+            self._buffer.extend(rows)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    @staticmethod
+    def _checked(rows):
+        """Rows that can be inserted: the others would fail the whole batch"""
+        valid = []
+        for row in rows:
+            error = check_row(row)
+            if error is None:
+                valid.append(row)
+            else:
+                INGEST_OBSERVATIONS.labels("rejected").inc()
+                log_sampled("rejected_row", datastream_id=row.get("datastream_id"), error=error)
+        return valid
+
+    def due(self):
+        with self._lock:
+            return bool(self._buffer) and (
+                time.monotonic() - self._first_added >= self.flush_interval
+            )
+
+    def flush(self):
+        # One flush at a time, so batches reach the database in order
+        with self._flush_lock:
+            with self._lock:
+                rows, self._buffer = self._buffer, []
+                self._first_added = None
+            if rows:
+                self._write(rows)
+
+    def flush_if_due(self):
+        if self.due():
+            self.flush()
+
+    def close(self):
+        """Stop the flush thread and write what is left in the buffer"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        # Check a few times per interval so a batch never waits much longer than T
+        tick = max(self.flush_interval / 4, 0.01)
+        while not self._stop.wait(tick):
+            try:
+                self.flush_if_due()
+            except Exception:
+                logger.exception("Periodic observation flush failed")
+
+    def _write(self, rows):
+        # Keep the order of what is already waiting in the spool
+        if self.spool is not None and self.spool.pending():
+            self._spool(rows)
+            return
+        try:
+            rejected = write_observation_batch(rows, self.session_factory)
+            INGEST_OBSERVATIONS.labels("written").inc(len(rows) - len(rejected))
+            if rejected:
+                INGEST_OBSERVATIONS.labels("rejected").inc(len(rejected))
+            INGEST_BATCH_ROWS.observe(len(rows))
+        except RETRYABLE_ERRORS as e:
+            if self.spool is None:
+                INGEST_OBSERVATIONS.labels("lost").inc(len(rows))
+                logger.error("Database unavailable, lost batch of %d observations (%s)", len(rows), e)
+                return
+            logger.warning("Database unavailable, spooling batch of %d observations", len(rows))
+            self._spool(rows)
+        except Exception:
+            INGEST_OBSERVATIONS.labels("lost").inc(len(rows))
+            logger.exception("Failed to insert batch of %d observations", len(rows))
+
+    def _spool(self, rows):
+        try:
+            self.spool.append(rows)
+            INGEST_OBSERVATIONS.labels("spooled").inc(len(rows))
+        except SpoolFull as e:
+            INGEST_OBSERVATIONS.labels("lost").inc(len(rows))
+            logger.error("Lost batch of %d observations: %s", len(rows), e)
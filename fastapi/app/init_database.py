@@ -2,7 +2,9 @@ import logging
 from sqlalchemy import text
 
 from database import engine, Base
-from init_database_tools import init_database_extension, init_database_optimize
+from init_database_tools import (
+    init_database_extension, init_database_optimize, init_database_aggregates, init_database_latest
+)
 import models
 
 
@@ -22,3 +24,11 @@ logger.info("Tables created")
 # Hypertables 
 init_database_optimize()
 logger.info("Observations table optimized")
+
+# Continuous aggregates
+init_database_aggregates()
+logger.info("Continuous aggregates created")
+
+# Dernières valeurs des observations déjà en base
+init_database_latest()
+logger.info("Latest observations filled")
@@ -1,6 +1,8 @@
 import logging
 from sqlalchemy import text
+from sqlalchemy.orm import Session
 from database import engine
+from latest import backfill_latest
 
 logger = logging.getLogger(__name__)
 
@@ -99,3 +101,85 @@ def init_database_optimize():
             logger.error(f"Failed to optimize observations table: {e}")
             conn.rollback()
             raise
+
+
+# Continuous aggregates: (view, bucket width, refresh start offset, end offset, schedule)
+CONTINUOUS_AGGREGATES = [
+    ("observations_hourly", "1 hour", "3 days", "1 hour", "30 minutes"),
+    ("observations_daily", "1 day", "30 days", "1 day", "1 hour"),
+]
+
+
+def init_database_aggregates():
+    """Create hourly and daily continuous aggregates per datastream, with refresh policies"""
+    # CALL refresh_continuous_aggregate cannot run inside a transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        try:
+            for view, width, start_offset, end_offset, schedule in CONTINUOUS_AGGREGATES:
+                exists = conn.execute(text("""
+                    SELECT EXISTS (
+                        SELECT 1 FROM timescaledb_information.continuous_aggregates
+                        WHERE view_name = :view
+                    )
+                """), {"view": view}).scalar()
+                if exists:
+                    logger.info(f"Continuous aggregate {view} already exists")
+                    continue
+
+                logger.info(f"Creating continuous aggregate {view} ({width} buckets)...")
+
+                # 1. Aggregates that can be combined again into coarser buckets
+                # (avg is recomputed from sum and count)
+                conn.execute(text(f"""
+                    CREATE MATERIALIZED VIEW {view}
+                    WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+                    SELECT
+                        time_bucket(INTERVAL '{width}', "phenomenonTime") AS bucket,
+                        datastream_id,
+                        avg(result) AS avg,
+                        min(result) AS min,
+                        max(result) AS max,
+                        sum(result) AS sum,
+                        count(result) AS count,
+                        first(result, "phenomenonTime") AS first,
+                        last(result, "phenomenonTime") AS last
+                    FROM observations
+                    GROUP BY bucket, datastream_id
+                    WITH NO DATA
+                """))
+
+                conn.execute(text(f"""
+                    CREATE INDEX IF NOT EXISTS idx_{view}_datastream_bucket
+                    ON {view} (datastream_id, bucket DESC)
+                """))
+
+                # 2. Refresh policy, recent buckets come from raw rows (real-time aggregation)
+                conn.execute(text(f"""
+                    SELECT add_continuous_aggregate_policy(
+                        '{view}',
+                        start_offset => INTERVAL '{start_offset}',
+                        end_offset => INTERVAL '{end_offset}',
+                        schedule_interval => INTERVAL '{schedule}',
+                        if_not_exists => TRUE
+                    )
+                """))
+
+                # 3. Materialize the existing history once
+                conn.execute(text(f"CALL refresh_continuous_aggregate('{view}', NULL, NULL)"))
+
+            logger.info("""
+                Continuous aggregates ready:
+                - observations_hourly, observations_daily per datastream
+                - avg, min, max, sum, count, first, last
+            """)
+
+        except Exception as e:
+            logger.error(f"Failed to create continuous aggregates: {e}")
+            raise
+
+
+def init_database_latest():
+    """Fill latest_observations for datastreams that already have observations"""
+    with Session(engine) as session:
+        backfill_latest(session)
+        session.commit()
@@ -0,0 +1,161 @@
+import os
+import time
+import threading
+from datetime import datetime, timezone
+from sqlalchemy import delete, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from models import LatestObservation
+from database import SessionLocal
+
+
+# The table is written by every ingest process: reload it after this delay (seconds)
+LATEST_CACHE_TTL = float(os.getenv("LATEST_CACHE_TTL", 5))
+
+LATEST_COLUMNS = ("phenomenonTime", "resultTime", "result")
+
+
+def as_utc(value):
+    """Aware datetime, naive ones being taken as UTC; other values unchanged"""
+    if isinstance(value, datetime) and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def latest_rows(rows):
+    """Most recent row of each datastream among observation rows (phenomenonTime already parsed).
+
+    Times are compared, and returned, as aware datetimes: the ones loaded
+    from latest_observations always are.
+    """
+    latest = {}
+    for row in rows:
+        row = {**row, "phenomenonTime": as_utc(row["phenomenonTime"]), "resultTime": as_utc(row.get("resultTime"))}
+        current = latest.get(row["datastream_id"])
+        if current is None or row["phenomenonTime"] >= current["phenomenonTime"]:
+            latest[row["datastream_id"]] = row
+    return latest
+
+
+def upsert_latest(session: Session, rows, replace_same_time=True):
+    """Move latest_observations forward with observation rows, without committing.
+
+    Older observations (late or replayed data) never replace a newer one; one
+    with the same phenomenonTime only does with `replace_same_time`.
+    """
+    latest = latest_rows(rows)
+    if not latest:
+        return
+    table = LatestObservation.__table__
+    stmt = insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.datastream_id],
+        set_={col: stmt.excluded[col] for col in LATEST_COLUMNS},
+        where=stmt.excluded.phenomenonTime >= table.c.phenomenonTime if replace_same_time
+        else stmt.excluded.phenomenonTime > table.c.phenomenonTime,
+    )
+    # Same lock order in every transaction, so concurrent writers cannot deadlock
+    session.execute(stmt, [
+        {"datastream_id": ds_id, **{col: latest[ds_id].get(col) for col in LATEST_COLUMNS}}
+        for ds_id in sorted(latest)
+    ])
+
+
+LATEST_FROM_OBSERVATIONS = """
+    INSERT INTO latest_observations (datastream_id, "phenomenonTime", "resultTime", result)
+    SELECT DISTINCT ON (datastream_id) datastream_id, "phenomenonTime", "resultTime", result
+    FROM observations
+    {where}
+    ORDER BY datastream_id, "phenomenonTime" DESC
+    ON CONFLICT (datastream_id) DO NOTHING
+"""
+
+
+def backfill_latest(session: Session):
+    """Fill latest_observations from the observations hypertable, for existing data"""
+    session.execute(text(LATEST_FROM_OBSERVATIONS.format(where="")))
+
+
+def refresh_latest(session: Session, datastream_id):
+    """Recompute the latest_observations row of a datastream from the hypertable,
+    without committing, after one of its observations was changed or deleted.
+    Returns the new latest entry, None when the datastream has no observation left."""
+    session.execute(delete(LatestObservation).where(LatestObservation.datastream_id == datastream_id))
+    session.execute(
+        text(LATEST_FROM_OBSERVATIONS.format(where="WHERE datastream_id = :datastream_id")),
+        {"datastream_id": datastream_id},
+    )
+    row = session.query(LatestObservation).filter(LatestObservation.datastream_id == datastream_id).first()
+    return None if row is None else {col: getattr(row, col) for col in LATEST_COLUMNS}
+
+
+## LATEST CACHE _______________________________________________________
+class LatestCache:
+    """In-memory latest observation per datastream id.
+
+    Updated by the writes of this process, and reloaded from the
+    latest_observations table on first use and every `ttl` seconds to pick
+    up those of the other ingest processes. Reads never touch the
+    observations hypertable.
+    """
+
+    def __init__(self, ttl=LATEST_CACHE_TTL, session_factory=SessionLocal):
+        self.ttl = ttl
+        self.session_factory = session_factory
+
+        self._entries = {}  # datastream_id -> {"phenomenonTime", "resultTime", "result"}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def update(self, rows):
+        """Record committed observation rows"""
+        latest = latest_rows(rows)
+        with self._lock:
+            for ds_id, row in latest.items():
+                current = self._entries.get(ds_id)
+                if current is None or row["phenomenonTime"] >= current["phenomenonTime"]:
+                    self._entries[ds_id] = {col: row.get(col) for col in LATEST_COLUMNS}
+
+    def discard(self, datastream_id):
+        with self._lock:
+            self._entries.pop(datastream_id, None)
+
+    def replace(self, datastream_id, entry):
+        """Set the entry of a datastream even if older (from refresh_latest), or drop it when None"""
+        if entry is None:
+            self.discard(datastream_id)
+            return
+        with self._lock:
+            self._entries[datastream_id] = entry
+
+    def load(self):
+        session: Session = self.session_factory()
+        try:
+            entries = {
+                r.datastream_id: {col: getattr(r, col) for col in LATEST_COLUMNS}
+                for r in session.query(LatestObservation)
+            }
+        finally:
+            session.close()
+        with self._lock:
+            self._entries = entries
+            self._loaded_at = time.monotonic()
+
+    def snapshot(self, datastream_ids=None):
+        """{datastream_id: latest} of all datastreams, or of `datastream_ids`"""
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+            # One reload at a time, the others keep answering from the current entries
+            if self._load_lock.acquire(blocking=self._loaded_at is None):
+                try:
+                    self.load()
+                finally:
+                    self._load_lock.release()
+        with self._lock:
+            if datastream_ids is None:
+                return dict(self._entries)
+            return {ds_id: self._entries[ds_id] for ds_id in datastream_ids if ds_id in self._entries}
+
+
+latest_cache = LatestCache()
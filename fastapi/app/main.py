@@ -1,19 +1,28 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+import os
 import threading
 import logging
 
 from database import engine, Base
+from response_cache import cache_middleware
+import cache_channel
 from routes import (
     thing, sensor, datastream, observation,
-    observed_property, location, feature_of_interest
+    observed_property, location, feature_of_interest,
+    create_observations
 )
-import mqtt_listener
 
 
+# Set to false when ingest runs as its own service (ingest.py)
+MQTT_LISTENER_ENABLED = os.getenv("MQTT_LISTENER_ENABLED", "true").lower() == "true"
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="BDOH IoT API - SensorThings Compliant")
+# Metadata GETs served from memory, with ETag / If-None-Match
+app.middleware("http")(cache_middleware)
 
 API_PREFIX = "/v1.0"
 
@@ -21,10 +30,36 @@ app.include_router(thing.router, prefix=f"{API_PREFIX}/Things", tags=["Things"])
 app.include_router(sensor.router, prefix=f"{API_PREFIX}/Sensors", tags=["Sensors"])
 app.include_router(datastream.router, prefix=f"{API_PREFIX}/Datastreams", tags=["Datastreams"])
 app.include_router(observation.router, prefix=f"{API_PREFIX}/Observations", tags=["Observations"])
+app.include_router(create_observations.router, prefix=f"{API_PREFIX}/CreateObservations", tags=["Observations"])
 app.include_router(observed_property.router, prefix=f"{API_PREFIX}/ObservedProperties", tags=["ObservedProperties"])
 app.include_router(location.router, prefix=f"{API_PREFIX}/Locations", tags=["Locations"])
 app.include_router(feature_of_interest.router, prefix=f"{API_PREFIX}/FeaturesOfInterest", tags=["FeaturesOfInterest"])
 
 
-threading.Thread(target=mqtt_listener.start, daemon=True).start()
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    # Prometheus text format, for this API process
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.on_event("startup")
+def start_cache_listener():
+    # Invalidations published by the other API workers
+    cache_channel.start_listener(engine)
+
+
+if MQTT_LISTENER_ENABLED:
+    import mqtt_listener
+
+    threading.Thread(target=mqtt_listener.start, daemon=True).start()
+
+    @app.get("/ingest/stats", tags=["Ingest"])
+    def ingest_stats():
+        # Queue depth and overflow counters, to size INGEST_WORKERS / INGEST_QUEUE_SIZE
+        return mqtt_listener.stats()
+
+    @app.on_event("shutdown")
+    def shutdown_mqtt_listener():
+        # Write the observations still buffered by the listener
+        mqtt_listener.stop()
 
@@ -0,0 +1,99 @@
+import os
+import json
+import random
+import logging
+from prometheus_client import Counter, Gauge, Histogram
+
+
+logger = logging.getLogger("ingest")
+
+# Share of per-message events that are logged (1 = all, 0 = none)
+INGEST_LOG_SAMPLE_RATE = float(os.getenv("INGEST_LOG_SAMPLE_RATE", 0.01))
+
+STAGE_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+
+## INGEST METRICS _____________________________________________________
+# decode, resolve, queue_wait are per message; insert, commit are per batch
+INGEST_STAGE_SECONDS = Histogram(
+    "bdoh_ingest_stage_seconds",
+    "Time spent in each MQTT ingest stage",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+INGEST_MESSAGES = Counter(
+    "bdoh_ingest_messages_total",
+    "MQTT messages by outcome (accepted, duplicate, rejected, unknown_topic)",
+    ["outcome"],
+)
+INGEST_SAMPLES = Counter(
+    "bdoh_ingest_samples_total",
+    "Observations of routed MQTT messages, after the in-memory dedup window (accepted, duplicate)",
+    ["outcome"],
+)
+INGEST_OBSERVATIONS = Counter(
+    "bdoh_ingest_observations_total",
+    "Observations leaving the batch writers by outcome (written, spooled, rejected, lost)",
+    ["outcome"],
+)
+INGEST_BATCH_ROWS = Histogram(
+    "bdoh_ingest_batch_rows",
+    "Rows per batch written to the database",
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000),
+)
+INGEST_QUEUE_EVENTS = Counter(
+    "bdoh_ingest_queue_events_total",
+    "Ingest queue events (enqueued, dropped, spilled)",
+    ["event"],
+)
+INGEST_QUEUE_DEPTH = Gauge(
+    "bdoh_ingest_queue_depth",
+    "Messages waiting in the ingest queue",
+)
+SPOOL_BYTES = Gauge(
+    "bdoh_spool_bytes",
+    "Bytes held in the on-disk spool segments",
+    ["spool"],
+)
+
+
+## API METRICS ________________________________________________________
+RESPONSE_CACHE_REQUESTS = Counter(
+    "bdoh_response_cache_requests_total",
+    "Cacheable metadata GETs by outcome (hit, not_modified, miss)",
+    ["outcome"],
+)
+
+
+
+## DATABASE POOL METRICS ______________________________________________
+# Saturation of a pool: bdoh_db_pool_checked_out / bdoh_db_pool_capacity
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    "bdoh_db_pool_checkout_seconds",
+    "Time to get a connection from the pool, waiting included",
+    ["pool"],
+    buckets=STAGE_BUCKETS,
+)
+DB_POOL_TIMEOUTS = Counter(
+    "bdoh_db_pool_timeouts_total",
+    "Checkouts that gave up after DB_POOL_TIMEOUT",
+    ["pool"],
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "bdoh_db_pool_checked_out",
+    "Connections in use",
+    ["pool"],
+)
+DB_POOL_CAPACITY = Gauge(
+    "bdoh_db_pool_capacity",
+    "Maximum connections of the pool (pool_size + max_overflow)",
+    ["pool"],
+)
+
+def log_sampled(event, **fields):
+    """Structured (JSON) log line for a per-message event, for a sample of them only"""
+    if INGEST_LOG_SAMPLE_RATE >= 1 or random.random() < INGEST_LOG_SAMPLE_RATE:
+        logger.info(json.dumps({"event": event, "sample_rate": INGEST_LOG_SAMPLE_RATE, **fields}, default=str))
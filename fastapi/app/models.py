@@ -137,3 +137,13 @@ class Observation(Base):
     __table_args__ = (
         PrimaryKeyConstraint('phenomenonTime', 'datastream_id'),
     )
+
+
+## LATEST OBSERVATION ____________
+# Dernière observation de chaque Datastream, tenue à jour par l'ingestion
+class LatestObservation(Base):
+    __tablename__ = "latest_observations"
+    datastream_id = Column(String, ForeignKey("datastreams.id", ondelete="CASCADE"), primary_key=True)
+    phenomenonTime = Column(DateTime(timezone=True), nullable=False)
+    resultTime = Column(DateTime(timezone=True))
+    result = Column(Float, nullable=False)
@@ -1,54 +1,115 @@
 import os
-import json
+import time
+import socket
+import logging
 import paho.mqtt.client as mqtt
-from sqlalchemy.orm import Session
-from models import Datastream, Observation
-from database import SessionLocal
+import cache_channel
+from topic_cache import topic_cache
+from database import ingest_engine
+from ingest_writer import observation_row, write_observation_batch
+from ingest_queue import IngestPool
+from spool import Spool, SPOOL_DIR
+from dedup import DedupWindow
+from payloads import decode_samples, message_encoding, PayloadError
+from metrics import INGEST_STAGE_SECONDS, INGEST_MESSAGES, INGEST_SAMPLES, log_sampled
+
+logger = logging.getLogger(__name__)
 
 
 MQTT_BROKER = os.getenv("MQTT_BROKER", "mosquitto")
 MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
+MQTT_TOPIC = os.getenv("MQTT_TOPIC", "iot/+/+")
+MQTT_QOS = int(os.getenv("MQTT_QOS", 1))
+# With a group, every listener subscribes to $share/<group>/<topic> and the broker
+# load-balances messages between them instead of sending each one to all
+MQTT_SHARED_GROUP = os.getenv("MQTT_SHARED_GROUP", "")
+MQTT_CLIENT_ID = os.getenv("MQTT_CLIENT_ID", f"bdoh-ingest-{socket.gethostname()}-{os.getpid()}")
+
+client = None
+# Drops QoS 1 redeliveries and re-published readings before they reach the database
+dedup_window = DedupWindow()
+
+def subscription():
+    if MQTT_SHARED_GROUP:
+        return f"$share/{MQTT_SHARED_GROUP}/{MQTT_TOPIC}"
+    return MQTT_TOPIC
 
-def on_connect(client, userdata, flags, rc):
-    print("Connected to MQTT broker")
-    client.subscribe("iot/+/+")
+def on_connect(client, userdata, flags, reason_code, properties):
+    logger.info("Connected to MQTT broker as %s", MQTT_CLIENT_ID)
+    client.subscribe(subscription(), qos=MQTT_QOS)
 
 def on_message(client, userdata, msg):
+    # Runs in the paho network thread: decode and enqueue only
     topic_parts = msg.topic.split("/")
     if len(topic_parts) != 3:
         return
     _, thing_id, observed_property = topic_parts
-    payload = json.loads(msg.payload.decode())
-
-    session: Session = SessionLocal()
+    # One decode per message, whatever the number of observations it carries
+    started = time.perf_counter()
     try:
-        ds = session.query(Datastream).filter_by(
-            thing_id=thing_id,
-            observed_property=observed_property
-        ).first()
-        if ds is None:
-            print(f"No datastream for {thing_id}/{observed_property}")
-            return
-        
-        # Create STA-compliant observation
-        obs = Observation(
-            phenomenonTime=payload.get("phenomenonTime", datetime.now().isoformat()),
-            result=payload["result"],
-            resultTime=payload.get("resultTime"),
-            parameters=payload.get("parameters", {}),
-            datastream_id=ds.id,
-            time=datetime.now()  # Your existing timestamp field
-        )
-        session.add(obs)
-        session.commit()
-        print(f"Inserted observation for {ds.id}")
-    finally:
-        session.close()
+        samples = decode_samples(msg.payload, message_encoding(msg))
+    except PayloadError as e:
+        INGEST_MESSAGES.labels("rejected").inc()
+        log_sampled("rejected", topic=msg.topic, error=str(e))
+        return
+    INGEST_STAGE_SECONDS.labels("decode").observe(time.perf_counter() - started)
+    if samples:
+        pool.submit(thing_id, observed_property, samples)
+
+def handle_message(item, writer):
+    # Runs in an ingest worker thread
+    with INGEST_STAGE_SECONDS.labels("resolve").time():
+        ds_id = topic_cache.resolve(item.thing_id, item.observed_property)
+    if ds_id is None:
+        INGEST_MESSAGES.labels("unknown_topic").inc()
+        log_sampled("unknown_topic", thing_id=item.thing_id, observed_property=item.observed_property)
+        return
+
+    # Create STA-compliant observations, written with the worker's next batch
+    rows = []
+    for sample in item.samples:
+        row = observation_row(ds_id, sample)
+        if not dedup_window.seen((ds_id, row["phenomenonTime"], row["result"])):
+            rows.append(row)
+    duplicates = len(item.samples) - len(rows)
+    INGEST_SAMPLES.labels("accepted").inc(len(rows))
+    INGEST_SAMPLES.labels("duplicate").inc(duplicates)
+    # A message whose samples were all seen already brings nothing new
+    outcome = "accepted" if rows else "duplicate"
+    INGEST_MESSAGES.labels(outcome).inc()
+    log_sampled(outcome, datastream_id=ds_id, observations=len(rows), duplicates=duplicates)
+    writer.add_many(rows)
+
+# Observations are queued (INGEST_QUEUE_SIZE, INGEST_OVERFLOW_POLICY) and written by
+# INGEST_WORKERS workers in batches (INGEST_BATCH_SIZE / INGEST_FLUSH_INTERVAL_MS).
+# While the database is down, batches go to an on-disk spool replayed once it is back.
+pool = IngestPool(
+    handle_message,
+    spool=Spool(os.path.join(SPOOL_DIR, "observations"), sink=write_observation_batch),
+    spill_dir=os.path.join(SPOOL_DIR, "spill"),
+)
+
+def stats():
+    return {**pool.stats(), "duplicates": dedup_window.duplicates}
 
 def start():
-    client = mqtt.Client()
+    """Connect and run the MQTT network loop until disconnected"""
+    global client
+    # Routing changes made by the API reach this process's topic cache by NOTIFY
+    cache_channel.start_listener(ingest_engine)
+    pool.start()
+    client = mqtt.Client(
+        mqtt.CallbackAPIVersion.VERSION2,
+        client_id=MQTT_CLIENT_ID,
+        protocol=mqtt.MQTTv5,
+    )
     client.on_connect = on_connect
     client.on_message = on_message
     client.connect(MQTT_BROKER, MQTT_PORT, 60)
     client.loop_forever()
- 
+
+def stop():
+    """Disconnect from the broker and flush queued observations"""
+    if client is not None:
+        client.disconnect()
+    pool.stop()
@@ -0,0 +1,494 @@
+import re
+import uuid
+from decimal import Decimal
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from fastapi import HTTPException
+from sqlalchemy import Boolean, DateTime, Float, Integer, and_, or_, not_, cast, func, select, literal, true, false
+from sqlalchemy.dialects.postgresql import JSONB
+
+from models import (
+    Thing, Location, Sensor, ObservedProperty, Datastream, Observation,
+    FeatureOfInterest, thing_location
+)
+
+
+class FilterError(ValueError):
+    pass
+
+
+## TOKENIZER __________________________________________________________
+_TIME = r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:Z|[+-]\d{2}:\d{2})?"
+_TOKEN = re.compile(rf"""\s*(?:
+    (?P<interval>{_TIME}/{_TIME})
+  | (?P<datetime>{_TIME}|\d{{4}}-\d{{2}}-\d{{2}})
+  | (?P<geo>(?:geography|geometry)'[^']*')
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+  | (?P<name>[A-Za-z_@][\w@.]*(?:/[A-Za-z_@][\w@.]*)*)
+  | (?P<punct>[(),])
+)""", re.X)
+
+COMPARISONS = ("eq", "ne", "gt", "ge", "lt", "le")
+KEYWORDS = {"true": True, "false": False, "null": None}
+
+
+def _datetime(text):
+    value = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    # Unqualified times are UTC
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def tokenize(text):
+    tokens, pos = [], 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if not match or match.end() == pos:
+            raise FilterError(f"Unexpected character at {pos}: {text[pos:pos + 20]!r}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "interval":
+            value = tuple(_datetime(part) for part in value.split("/"))
+        elif kind == "datetime":
+            value = _datetime(value)
+        elif kind == "geo":
+            value = value[value.index("'") + 1:-1]
+        elif kind == "string":
+            value = value[1:-1].replace("''", "'")
+        elif kind == "number":
+            value = float(value) if any(c in value for c in ".eE") else int(value)
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+
+## PARSER _____________________________________________________________
+# AST nodes are tuples: ("lit", value), ("geo", wkt), ("path", segments),
+# ("and" | "or", a, b), ("not", a), ("cmp", op, a, b), ("arith", op, a, b), ("call", name, args)
+
+class _Parser:
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def word(self):
+        kind, value = self.peek()
+        return value.lower() if kind == "name" else None
+
+    def expect(self, punct):
+        if self.take() != ("punct", punct):
+            raise FilterError(f"Expected {punct!r}")
+
+    def parse(self):
+        node = self.or_()
+        if self.pos != len(self.tokens):
+            raise FilterError(f"Unexpected {self.peek()[1]!r}")
+        return node
+
+    def or_(self):
+        node = self.and_()
+        while self.word() == "or":
+            self.take()
+            node = ("or", node, self.and_())
+        return node
+
+    def and_(self):
+        node = self.not_()
+        while self.word() == "and":
+            self.take()
+            node = ("and", node, self.not_())
+        return node
+
+    def not_(self):
+        if self.word() == "not":
+            self.take()
+            return ("not", self.not_())
+        return self.comparison()
+
+    def comparison(self):
+        node = self.additive()
+        if self.word() in COMPARISONS:
+            op = self.take()[1].lower()
+            node = ("cmp", op, node, self.additive())
+        return node
+
+    def additive(self):
+        node = self.multiplicative()
+        while self.word() in ("add", "sub"):
+            node = ("arith", self.take()[1].lower(), node, self.multiplicative())
+        return node
+
+    def multiplicative(self):
+        node = self.primary()
+        while self.word() in ("mul", "div", "mod"):
+            node = ("arith", self.take()[1].lower(), node, self.primary())
+        return node
+
+    def primary(self):
+        kind, value = self.take()
+        if kind is None:
+            raise FilterError("Unexpected end of filter")
+        if kind == "punct":
+            if value != "(":
+                raise FilterError(f"Unexpected {value!r}")
+            node = self.or_()
+            self.expect(")")
+            return node
+        if kind == "geo":
+            return ("geo", value)
+        if kind != "name":
+            return ("lit", value)
+        if value.lower() in KEYWORDS:
+            return ("lit", KEYWORDS[value.lower()])
+        if self.peek() == ("punct", "("):
+            self.take()
+            args = []
+            if self.peek() != ("punct", ")"):
+                args.append(self.or_())
+                while self.peek() == ("punct", ","):
+                    self.take()
+                    args.append(self.or_())
+            self.expect(")")
+            return ("call", value.lower(), tuple(args))
+        return ("path", tuple(value.split("/")))
+
+
+@lru_cache(maxsize=1024)
+def parse_filter(text):
+    """AST of a $filter expression, cached by filter string"""
+    return _Parser(tokenize(text)).parse()
+
+
+## ENTITIES ___________________________________________________________
+# Navigation from an entity to a related one: (target, local key, remote key, association table keys)
+NAVIGATION = {
+    Thing: {
+        "Datastreams": (Datastream, Thing.id, Datastream.thing_id, None),
+        "Locations": (Location, Thing.id, Location.id,
+                      (thing_location.c.thing_id, thing_location.c.location_id)),
+    },
+    Location: {
+        "Things": (Thing, Location.id, Thing.id,
+                   (thing_location.c.location_id, thing_location.c.thing_id)),
+    },
+    Sensor: {"Datastreams": (Datastream, Sensor.id, Datastream.sensor_id, None)},
+    ObservedProperty: {"Datastreams": (Datastream, ObservedProperty.id, Datastream.observed_property_id, None)},
+    Datastream: {
+        "Thing": (Thing, Datastream.thing_id, Thing.id, None),
+        "Sensor": (Sensor, Datastream.sensor_id, Sensor.id, None),
+        "ObservedProperty": (ObservedProperty, Datastream.observed_property_id, ObservedProperty.id, None),
+        "Observations": (Observation, Datastream.id, Observation.datastream_id, None),
+    },
+    Observation: {
+        "Datastream": (Datastream, Observation.datastream_id, Datastream.id, None),
+        "FeatureOfInterest": (FeatureOfInterest, Observation.feature_of_interest_id, FeatureOfInterest.id, None),
+    },
+    FeatureOfInterest: {
+        "Observations": (Observation, FeatureOfInterest.id, Observation.feature_of_interest_id, None),
+    },
+}
+
+
+def _property(model, name):
+    """Mapped column of an entity by SensorThings property name"""
+    if name == "@iot.id":
+        name = "id"
+    for prop in model.__mapper__.column_attrs:
+        if name in (prop.key, prop.columns[0].name):
+            return getattr(model, prop.key)
+    raise FilterError(f"Unknown property {name!r} of {model.__name__}")
+
+
+def _hop(hop, condition):
+    """Rows of the local entity related to a row of the target entity matching condition.
+
+    IN-subqueries on keys, so that e.g. Observations are selected through
+    datastream_id and the (datastream_id, phenomenonTime) index.
+    """
+    target, local, remote, via = hop
+    inner = select(remote).where(condition)
+    if via is not None:
+        inner = select(via[0]).where(via[1].in_(inner))
+    return local.in_(inner)
+
+
+## FUNCTIONS __________________________________________________________
+def _wkt(value):
+    return func.ST_GeomFromText(value, 4326)
+
+
+SPATIAL = {
+    "st_equals": "ST_Equals", "st_disjoint": "ST_Disjoint", "st_touches": "ST_Touches",
+    "st_within": "ST_Within", "st_overlaps": "ST_Overlaps", "st_crosses": "ST_Crosses",
+    "st_intersects": "ST_Intersects", "st_contains": "ST_Contains", "st_relate": "ST_Relate",
+    "geo.intersects": "ST_Intersects", "geo.distance": "ST_Distance", "geo.length": "ST_Length",
+}
+DATE_PARTS = {
+    "year": "year", "month": "month", "day": "day",
+    "hour": "hour", "minute": "minute", "second": "second",
+}
+TEMPORAL = ("overlaps", "during", "before", "after", "meets", "starts", "finishes")
+
+
+# String functions compiled to LIKE: function -> (value argument, pattern argument)
+LIKE = {"contains": (0, 1), "startswith": (0, 1), "endswith": (0, 1), "substringof": (1, 0)}
+
+
+def _like(name, value, pattern):
+    """value contains / starts with / ends with pattern, % and _ matching themselves"""
+    if isinstance(pattern, str):
+        method = "contains" if name == "substringof" else name
+        return getattr(value, method)(pattern, autoescape=True)
+    # Pattern read from a column: compared by position, there are no wildcards to escape
+    if name in ("contains", "substringof"):
+        return func.strpos(value, pattern) > 0
+    side = func.left if name == "startswith" else func.right
+    return side(value, func.length(pattern)) == pattern
+
+
+def _call(name, args):
+    if name in SPATIAL:
+        return getattr(func, SPATIAL[name])(*args)
+    if name in DATE_PARTS:
+        return func.extract(DATE_PARTS[name], args[0])
+    if name == "indexof":
+        return func.strpos(args[0], args[1], type_=Integer) - 1
+    if name == "substring":
+        return func.substr(args[0], args[1] + 1, *args[2:])
+    if name == "concat":
+        return args[0].concat(args[1])
+    simple = {
+        "length": lambda s: func.length(s, type_=Integer), "tolower": func.lower, "toupper": func.upper, "trim": func.trim,
+        "round": func.round, "floor": func.floor, "ceiling": func.ceil, "date": func.date,
+        "now": func.now, "fractionalseconds": lambda t: func.extract("microseconds", t) / 1e6 % 1,
+    }
+    if name in simple:
+        return simple[name](*args)
+    raise FilterError(f"Unknown function {name!r}")
+
+
+def _temporal(name, time, value):
+    """Instant `time` against an instant or a [start, end) interval, as plain range predicates"""
+    start, end = value if isinstance(value, tuple) else (value, value)
+    if name in ("overlaps", "during"):
+        return time == start if start == end else and_(time >= start, time < end)
+    if name == "before":
+        return time < start
+    if name == "after":
+        return time >= end if start != end else time > end
+    if name == "meets":
+        return or_(time == start, time == end)
+    if name == "starts":
+        return time == start
+    return time == end
+
+
+def _bucket(name, value):
+    """[start, end) of a year(...) or date(...) value, in UTC"""
+    if name == "year":
+        return datetime(value, 1, 1, tzinfo=timezone.utc), datetime(value + 1, 1, 1, tzinfo=timezone.utc)
+    day = value.replace(hour=0, minute=0, second=0, microsecond=0)
+    return day, day + timedelta(days=1)
+
+
+def _range(op, time, start, end):
+    if op == "eq":
+        return and_(time >= start, time < end)
+    if op == "ne":
+        return or_(time < start, time >= end)
+    return {"lt": time < start, "le": time < end, "gt": time >= end, "ge": time >= start}[op]
+
+
+FLIPPED = {"eq": "eq", "ne": "ne", "gt": "lt", "ge": "le", "lt": "gt", "le": "ge"}
+
+
+def _check_literal(column_type, value):
+    """FilterError when a literal cannot be compared with a value of `column_type`,
+    instead of a type error from the database"""
+    try:
+        expected = column_type.python_type
+    except (AttributeError, NotImplementedError):
+        return
+    if expected in (int, float, Decimal):
+        valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+    elif expected is bool:
+        valid = isinstance(value, bool)
+    elif expected is datetime:
+        valid = isinstance(value, datetime)
+    elif expected in (str, uuid.UUID):
+        valid = isinstance(value, str)
+    else:
+        return
+    if not valid:
+        raise FilterError(f"{value!r} cannot be compared with a {expected.__name__} value")
+
+
+## COMPILER ___________________________________________________________
+class _Compiler:
+
+    def __init__(self, model):
+        self.model = model
+        self._hops = None
+
+    # Boolean context
+    def condition(self, node):
+        kind = node[0]
+        if kind == "and":
+            return and_(self.condition(node[1]), self.condition(node[2]))
+        if kind == "or":
+            return or_(self.condition(node[1]), self.condition(node[2]))
+        if kind == "not":
+            return not_(self.condition(node[1]))
+        if kind == "lit" and isinstance(node[1], bool):
+            return true() if node[1] else false()
+        return self.predicate(node)
+
+    def predicate(self, node):
+        """Compile one comparison or boolean function against the entity it navigates to,
+        then select the rows of this entity related to it"""
+        self._hops = None
+        expression = self.comparison(node) if node[0] == "cmp" else self.expression(node)
+        for hop in reversed(self._hops or ()):
+            expression = _hop(hop, expression)
+        return expression
+
+    def resolve(self, segments):
+        """(column expression, column type, JSON path?) of a property path"""
+        model, hops = self.model, []
+        segments = list(segments)
+        while len(segments) > 1 and segments[0] in NAVIGATION.get(model, {}):
+            hop = NAVIGATION[model][segments.pop(0)]
+            hops.append(hop)
+            model = hop[0]
+        if self._hops is None:
+            self._hops = hops
+        elif self._hops != hops:
+            raise FilterError("Paths of one comparison must lead to the same entity")
+        column = _property(model, segments[0])
+        if len(segments) == 1:
+            return column, column.type, False
+        if not isinstance(column.type, JSONB):
+            raise FilterError(f"{segments[0]!r} has no member {segments[1]!r}")
+        # properties/key, unitOfMeasurement/name, parameters/a/b...
+        return column[tuple(segments[1:])].astext if len(segments) > 2 else column[segments[1]].astext, None, True
+
+    def comparison(self, node):
+        _, op, left, right = node
+        if left[0] in ("lit", "geo") and right[0] not in ("lit", "geo"):
+            # Column on the left: literal on the right, as index conditions are written
+            op, left, right = FLIPPED[op], right, left
+
+        # year(time) eq 2024, date(time) eq 2024-01-01: time range, usable by chunk exclusion and indexes
+        if left[0] == "call" and left[1] in ("year", "date") and right[0] == "lit" \
+                and len(left[2]) == 1 and left[2][0][0] == "path":
+            time, column_type, _ = self.resolve(left[2][0][1])
+            value = right[1]
+            if isinstance(column_type, DateTime) and (
+                    (left[1] == "year" and isinstance(value, int)) or
+                    (left[1] == "date" and isinstance(value, datetime))):
+                return _range(op, time, *_bucket(left[1], value))
+
+        if left[0] == "path" and right[0] == "lit":
+            column, column_type, is_json = self.resolve(left[1])
+            value = right[1]
+            if value is None:
+                if op not in ("eq", "ne"):
+                    raise FilterError("null can only be compared with eq / ne")
+                return column.is_(None) if op == "eq" else column.isnot(None)
+            if is_json:
+                if isinstance(value, bool):
+                    column = cast(column, Boolean)
+                elif isinstance(value, (int, float)):
+                    column = cast(column, Float)
+            elif isinstance(column_type, DateTime) and isinstance(value, str):
+                try:
+                    value = _datetime(value)
+                except ValueError:
+                    raise FilterError(f"Invalid time {value!r}")
+            if column_type is None:
+                return self._compare(op, column, value)
+            _check_literal(column_type, value)
+            return self._compare(op, column, literal(value, type_=column_type))
+
+        left_value, right_value = self.expression(left), self.expression(right)
+        if right[0] == "lit" and right[1] is not None:
+            _check_literal(left_value.type, right[1])
+        elif left[0] == "lit" and left[1] is not None:
+            _check_literal(right_value.type, left[1])
+        return self._compare(op, left_value, right_value)
+
+    @staticmethod
+    def _compare(op, left, right):
+        return {
+            "eq": lambda: left == right, "ne": lambda: left != right,
+            "gt": lambda: left > right, "ge": lambda: left >= right,
+            "lt": lambda: left < right, "le": lambda: left <= right,
+        }[op]()
+
+    # Value context
+    def expression(self, node):
+        kind = node[0]
+        if kind == "lit":
+            if isinstance(node[1], tuple):
+                raise FilterError("Time intervals are only allowed in temporal functions")
+            return literal(node[1])
+        if kind == "geo":
+            return _wkt(node[1])
+        if kind == "path":
+            return self.resolve(node[1])[0]
+        if kind == "cmp":
+            return self.comparison(node)
+        if kind in ("and", "or", "not"):
+            return self.condition(node)
+        if kind == "arith":
+            left, right = self.expression(node[2]), self.expression(node[3])
+            return {
+                "add": lambda: left + right, "sub": lambda: left - right,
+                "mul": lambda: left * right, "div": lambda: left / right,
+                "mod": lambda: left % right,
+            }[node[1]]()
+        # call
+        name, args = node[1], node[2]
+        if name in TEMPORAL:
+            if len(args) != 2 or args[1][0] != "lit" or not isinstance(args[1][1], (datetime, tuple)):
+                raise FilterError(f"{name}() compares a time with a time or an interval literal")
+            return _temporal(name, self.expression(args[0]), args[1][1])
+        if name in LIKE:
+            if len(args) != 2:
+                raise FilterError(f"Wrong number of arguments for {name}()")
+            value, pattern = (args[i] for i in LIKE[name])
+            if pattern[0] == "lit" and isinstance(pattern[1], str):
+                return _like(name, self.expression(value), pattern[1])
+            return _like(name, self.expression(value), self.expression(pattern))
+        try:
+            return _call(name, [self.expression(arg) for arg in args])
+        except IndexError:
+            raise FilterError(f"Wrong number of arguments for {name}()")
+
+
+def compile_filter(model, text):
+    """SQLAlchemy condition on `model` for a SensorThings $filter expression"""
+    return _Compiler(model).condition(parse_filter(text))
+
+
+def filter_condition(model, text):
+    """compile_filter, 400 on an invalid filter"""
+    try:
+        return compile_filter(model, text)
+    except ValueError as e:  # FilterError, or an invalid literal
+        raise HTTPException(status_code=400, detail=f"Invalid $filter: {e}")
+
+
+def apply_filter(query, model, text):
+    """query restricted by $filter, if any"""
+    return query.filter(filter_condition(model, text)) if text else query
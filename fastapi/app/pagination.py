@@ -0,0 +1,99 @@
+import os
+import json
+import base64
+from datetime import datetime
+from fastapi import HTTPException, Request
+from sqlalchemy import DateTime, literal, tuple_, text
+from sqlalchemy.orm import Session
+
+
+# Unfiltered $count on the observations hypertable uses TimescaleDB statistics instead of a full count
+OBSERVATIONS_COUNT_ESTIMATE = os.getenv("OBSERVATIONS_COUNT_ESTIMATE", "true").lower() == "true"
+
+
+## KEYSET PAGINATION __________________________________________________
+# $skiptoken carries the sort key of the last row of the previous page, so the
+# next page starts with an index seek instead of scanning and dropping $skip rows.
+
+def encode_cursor(values):
+    data = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token, keys):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError
+        return [
+            datetime.fromisoformat(v) if isinstance(key.type, DateTime) else v
+            for key, v in zip(keys, values)
+        ]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid $skiptoken")
+
+
+def after_cursor(keys, skiptoken, descending=False):
+    """Condition on `keys` selecting the rows after the one `skiptoken` points to"""
+    values = [literal(v, type_=key.type) for key, v in zip(keys, decode_cursor(skiptoken, keys))]
+    if len(keys) == 1:
+        return keys[0] < values[0] if descending else keys[0] > values[0]
+    return tuple_(*keys) < tuple_(*values) if descending else tuple_(*keys) > tuple_(*values)
+
+
+def paginate(query, request: Request, keys, top, skip=0, skiptoken=None, descending=False):
+    """Page of `query` ordered by `keys`, which must identify a row, and its @iot.nextLink.
+
+    With a `skiptoken` the page starts after the row it points to, otherwise
+    `skip` rows are skipped. The nextLink always continues with a skiptoken.
+    """
+    if skiptoken:
+        query = query.filter(after_cursor(keys, skiptoken, descending))
+
+    # OFFSET / LIMIT after ORDER BY: Query refuses order_by() once they are set
+    query = query.order_by(*[k.desc() if descending else k.asc() for k in keys])
+    if skip and not skiptoken:
+        query = query.offset(skip)
+    rows = query.limit(top + 1).all()
+
+    next_link = None
+    if len(rows) > top:
+        rows = rows[:top]
+        token = encode_cursor([getattr(rows[-1], key.key) for key in keys])
+        next_link = str(
+            request.url.remove_query_params("$skip").include_query_params(**{"$skiptoken": token})
+        )
+    return rows, next_link
+
+
+def collection(value, count=None, next_link=None):
+    """SensorThings collection response"""
+    page = {}
+    if count is not None:
+        page["@iot.count"] = count
+    page["value"] = value
+    if next_link:
+        page["@iot.nextLink"] = next_link
+    return page
+
+
+## $COUNT _____________________________________________________________
+def estimated_count(db: Session, table_name):
+    """Row count from planner / TimescaleDB chunk statistics, None when not analyzed yet"""
+    estimate = db.execute(
+        text("SELECT approximate_row_count(CAST(:table AS regclass))"), {"table": table_name}
+    ).scalar()
+    return estimate if estimate and estimate > 0 else None
+
+
+def count_query(db: Session, query, filtered=True, estimate_table=None):
+    """@iot.count of a collection query.
+
+    Without filters, and when `estimate_table` is given, the count comes from
+    statistics rather than from scanning every row.
+    """
+    if not filtered and estimate_table is not None:
+        estimate = estimated_count(db, estimate_table)
+        if estimate is not None:
+            return estimate
+    return query.count()
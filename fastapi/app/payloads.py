@@ -0,0 +1,153 @@
+import os
+import json
+from datetime import datetime, timezone
+from functools import lru_cache
+import msgpack
+import paho.mqtt.client as mqtt
+
+try:
+    import cbor2
+except ImportError:  # CBOR payloads are optional
+    cbor2 = None
+
+
+# Encoding per topic filter, first match wins, e.g. "iot/logger-1/+=msgpack;iot/+/+=json"
+MQTT_PAYLOAD_ENCODINGS = os.getenv("MQTT_PAYLOAD_ENCODINGS", "")
+MQTT_DEFAULT_ENCODING = os.getenv("MQTT_DEFAULT_ENCODING", "json")
+
+CONTENT_TYPES = {
+    "application/json": "json",
+    "application/msgpack": "msgpack",
+    "application/x-msgpack": "msgpack",
+    "application/vnd.msgpack": "msgpack",
+    "application/cbor": "cbor",
+}
+
+
+class PayloadError(ValueError):
+    pass
+
+
+def _parse_encodings(spec):
+    rules = []
+    for item in filter(None, (part.strip() for part in spec.split(";"))):
+        topic_filter, _, encoding = item.partition("=")
+        if encoding not in CONTENT_TYPES.values():
+            raise ValueError(f"Unknown payload encoding {encoding!r} for {topic_filter!r}")
+        rules.append((topic_filter, encoding))
+    return rules
+
+TOPIC_ENCODINGS = _parse_encodings(MQTT_PAYLOAD_ENCODINGS)
+
+
+@lru_cache(maxsize=10000)
+def topic_encoding(topic):
+    for topic_filter, encoding in TOPIC_ENCODINGS:
+        if mqtt.topic_matches_sub(topic_filter, topic):
+            return encoding
+    return MQTT_DEFAULT_ENCODING
+
+
+def message_encoding(msg):
+    """Encoding of a message: MQTT v5 content type, then a content-type user property, then the topic"""
+    properties = getattr(msg, "properties", None)
+    if properties is not None:
+        content_type = getattr(properties, "ContentType", None)
+        if content_type is None:
+            for name, value in getattr(properties, "UserProperty", None) or []:
+                if name.lower() == "content-type":
+                    content_type = value
+                    break
+        if content_type is not None:
+            encoding = CONTENT_TYPES.get(content_type.split(";")[0].strip().lower())
+            if encoding is None:
+                raise PayloadError(f"Unsupported content type {content_type!r}")
+            return encoding
+    return topic_encoding(msg.topic)
+
+
+def _loads(raw, encoding):
+    if encoding == "json":
+        return json.loads(raw)
+    if encoding == "msgpack":
+        return msgpack.unpackb(raw, timestamp=3)  # msgpack timestamps as datetime
+    if encoding == "cbor":
+        if cbor2 is None:
+            raise PayloadError("CBOR payload received but cbor2 is not installed")
+        return cbor2.loads(raw)
+    raise PayloadError(f"Unknown payload encoding {encoding!r}")
+
+
+def _result(value):
+    """Observation result as a float, the type of the result column"""
+    if value is None or isinstance(value, bool):
+        raise PayloadError(f"Invalid result {value!r}")
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise PayloadError(f"Invalid result {value!r}")
+
+
+def _time(value):
+    """ISO 8601 string, epoch seconds or datetime to an aware datetime (naive ones are UTC)"""
+    if value is None:
+        return None
+    try:
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            return datetime.fromtimestamp(value, tz=timezone.utc)
+        elif not isinstance(value, datetime):
+            raise TypeError
+    except (TypeError, ValueError, OverflowError, OSError):
+        raise PayloadError(f"Invalid time {value!r}")
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+
+def _sample(item):
+    if isinstance(item, (list, tuple)) and len(item) == 2:
+        item = {"phenomenonTime": item[0], "result": item[1]}
+    if not isinstance(item, dict):
+        raise PayloadError(f"Unsupported observation {item!r}")
+    if "result" not in item:
+        raise PayloadError("Observation without result")
+    return {
+        **item,
+        "result": _result(item["result"]),
+        "phenomenonTime": _time(item.get("phenomenonTime")),
+        "resultTime": _time(item.get("resultTime")),
+    }
+
+
+def decode_samples(raw, encoding="json"):
+    """Decode one message into a list of observation dicts.
+
+    Accepted shapes, in any encoding:
+    - one observation object: {"phenomenonTime": ..., "result": ...}
+    - a list of observation objects, or of [time, value] pairs
+    - a SensorThings-like {"components": [...], "dataArray": [[...], ...]}
+    Times are ISO 8601 strings, epoch seconds or native datetimes, returned as
+    aware datetimes; results are returned as floats. Anything else fails the
+    whole message with PayloadError.
+    """
+    try:
+        data = _loads(raw, encoding)
+    except PayloadError:
+        raise
+    except Exception as e:
+        raise PayloadError(f"Invalid {encoding} payload: {e}") from e
+
+    if isinstance(data, dict) and "dataArray" in data:
+        components = data.get("components", ["phenomenonTime", "result"])
+        if not isinstance(components, list) or "result" not in components:
+            raise PayloadError("dataArray components must include 'result'")
+        rows = data["dataArray"]
+        if not isinstance(rows, list):
+            raise PayloadError("dataArray must be a list of rows")
+        for row in rows:
+            if not isinstance(row, (list, tuple)) or len(row) != len(components):
+                raise PayloadError(f"dataArray row {row!r} does not match components {components}")
+        return [_sample(dict(zip(components, row))) for row in rows]
+    if isinstance(data, list):
+        return [_sample(item) for item in data]
+    return [_sample(data)]
@@ -0,0 +1,138 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from fastapi import Request, Response
+from sqlalchemy.orm import Session
+
+import cache_channel
+from metrics import RESPONSE_CACHE_REQUESTS
+
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 1000))
+# Larger responses are not kept (bytes)
+RESPONSE_CACHE_MAX_BODY = int(os.getenv("RESPONSE_CACHE_MAX_BODY", 1024 * 1024))
+# Writes invalidate every API worker through cache_channel: this only bounds how
+# long a response may stay outdated if a notification is lost (seconds)
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 30))
+
+# Metadata entity sets whose GET responses are cached, with their navigation endpoints
+CACHED_PREFIXES = tuple(
+    f"/v1.0/{name}" for name in ("Things", "Sensors", "ObservedProperties", "Locations", "FeaturesOfInterest")
+)
+
+
+def etag(body):
+    """Strong ETag of a response body: equal bodies get equal tags in every process"""
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def not_modified(request: Request, tag):
+    """Whether the If-None-Match header of the request matches `tag`"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return "*" in tags or tag in tags
+
+
+def cacheable(request: Request):
+    if request.method != "GET" or not request.url.path.startswith(CACHED_PREFIXES):
+        return False
+    # Observations (by navigation, $expand or $filter) change with every ingested message
+    return "Observations" not in request.url.path and "Observations" not in request.url.query
+
+
+## RESPONSE CACHE _____________________________________________________
+class ResponseCache:
+    """Bounded LRU cache of metadata GET responses, by URL.
+
+    Entries are (body, ETag, content type, expires_at). The POST / PATCH /
+    DELETE handlers of the metadata entities invalidate the whole cache, in
+    every API worker (invalidate_responses): with
+    $expand and $filter a response may depend on any entity set, and writes
+    are rare enough for a full clear to cost nothing.
+    """
+
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, max_body=RESPONSE_CACHE_MAX_BODY):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_body = max_body
+
+        self._entries = OrderedDict()  # url -> (body, etag, media_type, expires_at)
+        self._lock = threading.Lock()
+        # Bumped on every invalidation, so a response built while a write commits is not cached
+        self._generation = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[3] <= time.monotonic():
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body, media_type, generation):
+        tag = etag(body)
+        if len(body) <= self.max_body:
+            with self._lock:
+                if generation == self._generation:
+                    self._entries[key] = (body, tag, media_type, time.monotonic() + self.ttl)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_size:
+                        self._entries.popitem(last=False)
+        return tag
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+response_cache = ResponseCache()
+cache_channel.subscribe("responses", lambda key: response_cache.invalidate())
+
+
+def invalidate_responses(db: Session):
+    """Clear the response cache of every API worker. Call after the write has been committed."""
+    cache_channel.publish(db, "responses")
+
+
+def _response(request: Request, body, tag, media_type):
+    headers = {"ETag": tag, "Cache-Control": "no-cache"}
+    if not_modified(request, tag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+async def cache_middleware(request: Request, call_next):
+    """Serve metadata GETs from the response cache, with ETag / 304 Not Modified"""
+    if not cacheable(request):
+        return await call_next(request)
+
+    key = str(request.url)
+    entry = response_cache.get(key)
+    if entry is not None:
+        body, tag, media_type, _ = entry
+        response = _response(request, body, tag, media_type)
+        RESPONSE_CACHE_REQUESTS.labels("not_modified" if response.status_code == 304 else "hit").inc()
+        return response
+
+    generation = response_cache.generation
+    response = await call_next(request)
+    if response.status_code != 200:
+        return response
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    media_type = response.headers.get("content-type")
+    tag = response_cache.put(key, body, media_type, generation)
+    response = _response(request, body, tag, media_type)
+    RESPONSE_CACHE_REQUESTS.labels("not_modified" if response.status_code == 304 else "miss").inc()
+    return response
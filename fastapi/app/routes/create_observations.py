@@ -0,0 +1,85 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from pydantic import ValidationError
+from typing import Dict, Any, List
+
+from models import Datastream, FeatureOfInterest
+from schemas import ObservationCreate, ObservationDataArray, DATA_ARRAY_COMPONENTS
+from database import get_db
+from ingest_writer import insert_observations, written_rows, parse_time
+from latest import latest_cache
+
+router = APIRouter()
+
+
+## CREATE OBSERVATIONS _______________________________________________
+# SensorThings dataArray extension : many observations, several datastreams, one request
+@router.post("", response_model=List[Dict[str, Any]], status_code=201)
+def create_observations(
+    arrays: List[ObservationDataArray],
+    db: Session = Depends(get_db)
+):
+    # Check every referenced entity with one query per entity type
+    ds_ids = {a.Datastream.id for a in arrays}
+    known_ds = {
+        row[0] for row in db.query(Datastream.id).filter(Datastream.id.in_(ds_ids))
+    }
+    foi_ids = {
+        row[a.components.index("FeatureOfInterest/id")]
+        for a in arrays if "FeatureOfInterest/id" in a.components
+        for row in a.dataArray
+        if len(row) == len(a.components)
+    }
+    known_foi = {
+        row[0] for row in db.query(FeatureOfInterest.id).filter(FeatureOfInterest.id.in_(foi_ids))
+    } if foi_ids else set()
+
+    outcomes = []
+    rows = []
+    for array in arrays:
+        ds_id = array.Datastream.id
+        fields = [DATA_ARRAY_COMPONENTS[c] for c in array.components]
+        for values in array.dataArray:
+            if ds_id not in known_ds:
+                outcomes.append({"status": "error", "detail": f"Datastream {ds_id} not found"})
+                continue
+            if len(values) != len(fields):
+                outcomes.append({"status": "error", "detail": "Row does not match components"})
+                continue
+            data = dict(zip(fields, values))
+            data["datastream_id"] = ds_id
+            if data.get("feature_of_interest_id") not in (None, *known_foi):
+                outcomes.append({
+                    "status": "error",
+                    "detail": f"FeatureOfInterest {data['feature_of_interest_id']} not found"
+                })
+                continue
+            try:
+                obs = ObservationCreate(**data)
+            except ValidationError as e:
+                detail = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+                outcomes.append({"status": "error", "detail": detail})
+                continue
+            rows.append(obs.dict())
+            outcomes.append({
+                "status": "created",
+                "datastream_id": ds_id,
+                "phenomenonTime": obs.phenomenonTime,
+            })
+
+    # One transaction, one multi-row INSERT, no refresh
+    try:
+        written = insert_observations(db, rows, returning=True)
+        db.commit()
+    except IntegrityError as e:
+        db.rollback()
+        raise HTTPException(status_code=409, detail=f"Observations not created: {e.orig}")
+    latest_cache.update(written_rows(rows, written))
+
+    # Rows skipped because the observation already exists
+    for outcome in outcomes:
+        if outcome["status"] == "created" and \
+                (parse_time(outcome["phenomenonTime"]), outcome["datastream_id"]) not in written:
+            outcome["status"] = "duplicate"
+    return outcomes
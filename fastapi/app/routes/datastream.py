@@ -1,35 +1,94 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from sqlalchemy.orm import Session, joinedload
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Callable, List, Optional
 from datetime import datetime
 import uuid
 
 from models import Datastream, Thing, Sensor, ObservedProperty, Observation
 from schemas import DatastreamCreate, DatastreamUpdate, DatastreamResponse
-from database import get_db
+from database import get_db, get_db_runner, Offload
+from topic_cache import invalidate_topics
+from odata_filter import apply_filter
+from expand import expand_query, expand_page
+from serialization import select_query, entity_plan, json_response, encoded_response
+from pagination import paginate, collection
+from response_cache import invalidate_responses
+from aggregation import aggregate_observations, parse_interval, parse_functions
+from downsampling import check_method, read_series, downsample_series
+from export import export_observations, negotiate
+from latest import latest_cache
 
 router = APIRouter()
 
 
 ## DATASTREAMS _______________________________________________________
-@router.get("/", response_model=Dict[str, Any])
-def get_datastreams(
-    top: int = Query(100, alias="$top"),
-    skip: int = Query(0, alias="$skip"),
-    thing_id: Optional[str] = None,
-    sensor_id: Optional[str] = None,
-    db: Session = Depends(get_db)
+def datastreams_page(
+    db: Session, request: Request, top, skip, skiptoken, count, filter_, expand, select_, thing_id, sensor_id
 ):
-    query = db.query(Datastream)
+    plan = entity_plan(Datastream, expand, select_)
+    query = db.query(*plan.columns) if plan else db.query(Datastream)
     
     if thing_id:
         query = query.filter(Datastream.thing_id == thing_id)
     if sensor_id:
         query = query.filter(Datastream.sensor_id == sensor_id)
     
-    total = query.count()
-    datastreams = query.offset(skip).limit(top).all()
-    return {"@iot.count": total, "value": datastreams}
+    query = apply_filter(query, Datastream, filter_)
+    query, tree = expand_query(query, Datastream, expand)
+    query, fields = select_query(query, Datastream, select_)
+    total = query.count() if count else None
+    datastreams, next_link = paginate(query, request, [Datastream.id], top, skip, skiptoken)
+    # Encodage hors de la boucle d'événements (Offload)
+    if plan:
+        return Offload(lambda: json_response(collection(plan.dicts(datastreams), total, next_link)))
+    return Offload(encoded_response, collection(expand_page(db, datastreams, Datastream, tree, fields), total, next_link))
+
+
+# Route async : requêtes via asyncpg avec DB_ASYNC_ENABLED, sinon dans le threadpool
+@router.get("/", response_model=Dict[str, Any])
+async def get_datastreams(
+    request: Request,
+    top: int = Query(100, alias="$top"),
+    skip: int = Query(0, alias="$skip"),
+    skiptoken: Optional[str] = Query(None, alias="$skiptoken"),
+    count: bool = Query(True, alias="$count"),
+    filter_: Optional[str] = Query(None, alias="$filter"),
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
+    thing_id: Optional[str] = None,
+    sensor_id: Optional[str] = None,
+    run: Callable = Depends(get_db_runner)
+):
+    return await run(
+        datastreams_page, request, top, skip, skiptoken, count, filter_, expand, select_, thing_id, sensor_id
+    )
+
+
+# Valeur courante de tous les Datastreams (ou d'une sélection) en une réponse,
+# servie par le cache des dernières observations, sans lire l'hypertable
+@router.get("/Latest", response_model=Dict[str, Any])
+def get_datastreams_latest(
+    datastream_id: Optional[List[str]] = Query(None),
+    thing_id: Optional[str] = None,
+    observed_property_id: Optional[str] = None,
+    filter_: Optional[str] = Query(None, alias="$filter"),
+    db: Session = Depends(get_db)
+):
+    ids = datastream_id
+    if thing_id or observed_property_id or filter_:
+        query = db.query(Datastream.id)
+        if datastream_id:
+            query = query.filter(Datastream.id.in_(datastream_id))
+        if thing_id:
+            query = query.filter(Datastream.thing_id == thing_id)
+        if observed_property_id:
+            query = query.filter(Datastream.observed_property_id == observed_property_id)
+        query = apply_filter(query, Datastream, filter_)
+        ids = [row.id for row in query]
+
+    latest = latest_cache.snapshot(ids)
+    value = [{"datastream_id": ds_id, **latest[ds_id]} for ds_id in sorted(latest)]
+    return {"@iot.count": len(value), "value": value}
 
 
 @router.post("/", response_model=DatastreamResponse, status_code=201)
@@ -53,7 +112,9 @@ def create_datastream(ds_data: DatastreamCreate, db: Session = Depends(get_db)):
     )
     db.add(db_ds)
     db.commit()
+    invalidate_responses(db)
     db.refresh(db_ds)
+    invalidate_topics(db, db_ds.thing_id)
     return db_ds
 
 
@@ -81,6 +142,7 @@ def update_datastream(
         raise HTTPException(status_code=404, detail="Datastream not found")
 
     update_data = ds_data.dict(exclude_unset=True)
+    previous_thing_id = datastream.thing_id
 
     # Convertir UnitOfMeasurement en dict pour JSONB
     if "unitOfMeasurement" in update_data:
@@ -90,7 +152,11 @@ def update_datastream(
         setattr(datastream, field, value)
 
     db.commit()
+    invalidate_responses(db)
     db.refresh(datastream)
+    invalidate_topics(db, datastream.thing_id)
+    if previous_thing_id != datastream.thing_id:
+        invalidate_topics(db, previous_thing_id)
     return datastream
 
 
@@ -99,16 +165,97 @@ def delete_datastream(datastream_id: str, db: Session = Depends(get_db)):
     datastream = db.query(Datastream).filter(Datastream.id == datastream_id).first()
     if not datastream:
         raise HTTPException(status_code=404, detail="Datastream not found")
+    thing_id = datastream.thing_id
     db.delete(datastream)
     db.commit()
+    invalidate_responses(db)
+    invalidate_topics(db, thing_id)
+    latest_cache.discard(datastream_id)
+
+
+def datastream_observations_page(
+    db: Session, request: Request, datastream_id, top, skip, skiptoken, count, filter_, expand, select_,
+    time_start, time_end, max_points, downsample
+):
+    datastream = db.query(Datastream).filter(Datastream.id == datastream_id).first()
+    if not datastream:
+        raise HTTPException(status_code=404, detail="Datastream not found")
+
+    # Série entière de l'intervalle [time_start, time_end) et du $filter, réduite pour l'affichage,
+    # dans l'ordre chronologique, sans pagination
+    if max_points:
+        check_method(downsample)
+        x, y = read_series(db, datastream_id, time_start, time_end, filter_)
+        return Offload(downsampled_response, x, y, max_points, downsample)
 
+    # Arrow / Parquet (ou NDJSON / CSV) demandés par Accept : la même page, en flux
+    fmt = negotiate(request)
+    if fmt:
+        return export_observations(
+            fmt, datastream_id, time_start, time_end,
+            filename=f"datastream-{datastream_id}", filter_text=filter_, select_text=select_,
+            top=top, skip=skip, skiptoken=skiptoken, keys=[Observation.phenomenonTime], descending=True
+        )
+
+    plan = entity_plan(Observation, expand, select_)
+    query = (db.query(*plan.columns) if plan else db.query(Observation)).filter(
+        Observation.datastream_id == datastream_id
+    )
+
+    if time_start:
+        query = query.filter(Observation.phenomenonTime >= time_start)
+    if time_end:
+        query = query.filter(Observation.phenomenonTime <= time_end)
+
+    query = apply_filter(query, Observation, filter_)
+    query, tree = expand_query(query, Observation, expand)
+    query, fields = select_query(query, Observation, select_)
+    total = query.count() if count else None
+    observations, next_link = paginate(
+        query, request, [Observation.phenomenonTime], top, skip, skiptoken, descending=True
+    )
 
-# SensorThings : Observations d'un Datastream
+    if plan:
+        return Offload(lambda: json_response(collection(plan.dicts(observations), total, next_link)))
+    return Offload(encoded_response, collection(expand_page(db, observations, Observation, tree, fields), total, next_link))
+
+
+def downsampled_response(x, y, max_points, method):
+    total, points = downsample_series(x, y, max_points, method)
+    return encoded_response({"downsample": method, "@iot.count": total, "value": points})
+
+
+# SensorThings : Observations d'un Datastream (async, comme GET /Observations)
 @router.get("({datastream_id})/Observations", response_model=Dict[str, Any])
-def get_datastream_observations(
+async def get_datastream_observations(
+    request: Request,
     datastream_id: str,
     top: int = Query(100, alias="$top"),
     skip: int = Query(0, alias="$skip"),
+    skiptoken: Optional[str] = Query(None, alias="$skiptoken"),
+    count: bool = Query(False, alias="$count"),
+    filter_: Optional[str] = Query(None, alias="$filter"),
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
+    time_start: Optional[datetime] = None,
+    time_end: Optional[datetime] = None,
+    max_points: Optional[int] = Query(None, ge=3, le=100000, description="Downsample the range to this many points"),
+    downsample: str = Query("lttb", description="Downsampling method with max_points: lttb or minmax"),
+    run: Callable = Depends(get_db_runner)
+):
+    return await run(
+        datastream_observations_page, request, datastream_id, top, skip, skiptoken, count, filter_,
+        expand, select_, time_start, time_end, max_points, downsample
+    )
+
+
+# Export en flux (NDJSON / CSV) des Observations d'un Datastream, sans pagination
+@router.get("({datastream_id})/Observations/export")
+def export_datastream_observations(
+    datastream_id: str,
+    format: str = Query("ndjson", description="ndjson, csv, arrow or parquet"),
+    filter_: Optional[str] = Query(None, alias="$filter"),
+    select_: Optional[str] = Query(None, alias="$select"),
     time_start: Optional[datetime] = None,
     time_end: Optional[datetime] = None,
     db: Session = Depends(get_db)
@@ -116,44 +263,86 @@ def get_datastream_observations(
     datastream = db.query(Datastream).filter(Datastream.id == datastream_id).first()
     if not datastream:
         raise HTTPException(status_code=404, detail="Datastream not found")
+    return export_observations(
+        format, datastream_id, time_start, time_end,
+        filename=f"datastream-{datastream_id}", filter_text=filter_, select_text=select_
+    )
 
-    query = db.query(Observation).filter(Observation.datastream_id == datastream_id)
 
-    if time_start:
-        query = query.filter(Observation.phenomenonTime >= time_start)
-    if time_end:
-        query = query.filter(Observation.phenomenonTime <= time_end)
-
-    total = query.count()
-    observations = query.order_by(
-        Observation.phenomenonTime.desc()
-    ).offset(skip).limit(top).all()
+# Agrégation par intervalle de temps (TimescaleDB time_bucket), calculée en base
+@router.get("({datastream_id})/Observations/aggregate", response_model=Dict[str, Any])
+def get_datastream_observations_aggregate(
+    datastream_id: str,
+    interval: str = Query(..., description="Bucket width, e.g. 15min, 1h, 1d or PT15M"),
+    functions: str = Query("avg", description="Comma-separated: avg,min,max,sum,count,first,last"),
+    time_start: Optional[datetime] = None,
+    time_end: Optional[datetime] = None,
+    db: Session = Depends(get_db)
+):
+    datastream = db.query(Datastream).filter(Datastream.id == datastream_id).first()
+    if not datastream:
+        raise HTTPException(status_code=404, detail="Datastream not found")
 
-    return {"@iot.count": total, "value": observations}
+    # Lit les agrégats continus (horaire / journalier) quand ils couvrent la demande
+    source, buckets = aggregate_observations(
+        db, datastream_id, parse_interval(interval), parse_functions(functions),
+        time_start, time_end
+    )
+    return {"interval": interval, "source": source, "@iot.count": len(buckets), "value": buckets}
 
 
 # SensorThings : Thing d'un Datastream
 @router.get("({datastream_id})/Thing", response_model=Dict[str, Any])
-def get_datastream_thing(datastream_id: str, db: Session = Depends(get_db)):
+def get_datastream_thing(
+    datastream_id: str,
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
+    db: Session = Depends(get_db)
+):
     datastream = db.query(Datastream).filter(Datastream.id == datastream_id).first()
     if not datastream:
         raise HTTPException(status_code=404, detail="Datastream not found")
-    return datastream.Thing
+    if not expand and not select_:
+        return datastream.Thing
+    query, tree = expand_query(db.query(Thing).filter(Thing.id == datastream.thing_id), Thing, expand)
+    query, fields = select_query(query, Thing, select_)
+    return expand_page(db, query.all(), Thing, tree, fields)[0]
 
 
 # SensorThings : Sensor d'un Datastream
 @router.get("({datastream_id})/Sensor", response_model=Dict[str, Any])
-def get_datastream_sensor(datastream_id: str, db: Session = Depends(get_db)):
+def get_datastream_sensor(
+    datastream_id: str,
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
+    db: Session = Depends(get_db)
+):
     datastream = db.query(Datastream).filter(Datastream.id == datastream_id).first()
     if not datastream:
         raise HTTPException(status_code=404, detail="Datastream not found")
-    return datastream.Sensor
+    if not expand and not select_:
+        return datastream.Sensor
+    query, tree = expand_query(db.query(Sensor).filter(Sensor.id == datastream.sensor_id), Sensor, expand)
+    query, fields = select_query(query, Sensor, select_)
+    return expand_page(db, query.all(), Sensor, tree, fields)[0]
 
 
 # SensorThings : ObservedProperty d'un Datastream
 @router.get("({datastream_id})/ObservedProperty", response_model=Dict[str, Any])
-def get_datastream_observed_property(datastream_id: str, db: Session = Depends(get_db)):
+def get_datastream_observed_property(
+    datastream_id: str,
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
+    db: Session = Depends(get_db)
+):
     datastream = db.query(Datastream).filter(Datastream.id == datastream_id).first()
     if not datastream:
         raise HTTPException(status_code=404, detail="Datastream not found")
-    return datastream.ObservedProperty
+    if not expand and not select_:
+        return datastream.ObservedProperty
+    query, tree = expand_query(
+        db.query(ObservedProperty).filter(ObservedProperty.id == datastream.observed_property_id),
+        ObservedProperty, expand
+    )
+    query, fields = select_query(query, ObservedProperty, select_)
+    return expand_page(db, query.all(), ObservedProperty, tree, fields)[0]
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from sqlalchemy.orm import Session
 from typing import Dict, Any, Optional
 from geoalchemy2.shape import from_shape
@@ -6,9 +6,15 @@ from shapely.geometry import shape
 from datetime import datetime
 import uuid
 
-from models import FeatureOfInterest
+from models import FeatureOfInterest, Observation
 from schemas import FeatureOfInterestCreate, FeatureOfInterestUpdate, FeatureOfInterestResponse
 from database import get_db
+from odata_filter import apply_filter
+from expand import expand_query, expand_page
+from serialization import select_query, entity_plan, json_response
+from pagination import paginate, collection
+from response_cache import invalidate_responses
+from export import export_observations, negotiate
 
 router = APIRouter()
 
@@ -16,14 +22,23 @@ router = APIRouter()
 ## FEATURES OF INTEREST ______________________________________________
 @router.get("/", response_model=Dict[str, Any])
 def get_features_of_interest(
+    request: Request,
     top: int = Query(100, alias="$top"),
     skip: int = Query(0, alias="$skip"),
+    skiptoken: Optional[str] = Query(None, alias="$skiptoken"),
+    count: bool = Query(True, alias="$count"),
+    filter_: Optional[str] = Query(None, alias="$filter"),
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
     db: Session = Depends(get_db)
 ):
     query = db.query(FeatureOfInterest)
-    total = query.count()
-    fois = query.offset(skip).limit(top).all()
-    return {"@iot.count": total, "value": fois}
+    query = apply_filter(query, FeatureOfInterest, filter_)
+    query, tree = expand_query(query, FeatureOfInterest, expand)
+    query, fields = select_query(query, FeatureOfInterest, select_)
+    total = query.count() if count else None
+    fois, next_link = paginate(query, request, [FeatureOfInterest.id], top, skip, skiptoken)
+    return collection(expand_page(db, fois, FeatureOfInterest, tree, fields), total, next_link)
 
 
 @router.post("/", response_model=FeatureOfInterestResponse, status_code=201)
@@ -42,6 +57,7 @@ def create_feature_of_interest(foi_data: FeatureOfInterestCreate, db: Session =
     )
     db.add(db_foi)
     db.commit()
+    invalidate_responses(db)
     db.refresh(db_foi)
     return db_foi
 
@@ -77,6 +93,7 @@ def update_feature_of_interest(
         setattr(foi, field, value)
 
     db.commit()
+    invalidate_responses(db)
     db.refresh(foi)
     return foi
 
@@ -88,20 +105,49 @@ def delete_feature_of_interest(foi_id: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="FeatureOfInterest not found")
     db.delete(foi)
     db.commit()
+    invalidate_responses(db)
 
 
 # SensorThings : Observations d'une FeatureOfInterest
 @router.get("({foi_id})/Observations", response_model=Dict[str, Any])
 def get_foi_observations(
+    request: Request,
     foi_id: str,
     top: int = Query(100, alias="$top"),
     skip: int = Query(0, alias="$skip"),
+    skiptoken: Optional[str] = Query(None, alias="$skiptoken"),
+    count: bool = Query(False, alias="$count"),
+    filter_: Optional[str] = Query(None, alias="$filter"),
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
     db: Session = Depends(get_db)
 ):
     foi = db.query(FeatureOfInterest).filter(FeatureOfInterest.id == foi_id).first()
     if not foi:
         raise HTTPException(status_code=404, detail="FeatureOfInterest not found")
-    
-    total = len(foi.Observations)
-    observations = foi.Observations[skip:skip+top]
-    return {"@iot.count": total, "value": observations}
+
+    # Arrow / Parquet (ou NDJSON / CSV) demandés par Accept : la même page, en flux
+    fmt = negotiate(request)
+    if fmt:
+        return export_observations(
+            fmt, feature_of_interest_id=foi_id, filename=f"foi-{foi_id}",
+            filter_text=filter_, select_text=select_, top=top, skip=skip, skiptoken=skiptoken,
+            keys=[Observation.phenomenonTime, Observation.datastream_id], descending=True
+        )
+
+    # Paged in SQL rather than loading foi.Observations
+    plan = entity_plan(Observation, expand, select_)
+    query = (db.query(*plan.columns) if plan else db.query(Observation)).filter(
+        Observation.feature_of_interest_id == foi_id
+    )
+    query = apply_filter(query, Observation, filter_)
+    query, tree = expand_query(query, Observation, expand)
+    query, fields = select_query(query, Observation, select_)
+    total = query.count() if count else None
+    observations, next_link = paginate(
+        query, request, [Observation.phenomenonTime, Observation.datastream_id],
+        top, skip, skiptoken, descending=True
+    )
+    if plan:
+        return json_response(collection(plan.dicts(observations), total, next_link))
+    return collection(expand_page(db, observations, Observation, tree, fields), total, next_link)
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from sqlalchemy.orm import Session
 from sqlalchemy import func
 from typing import Dict, Any, Optional
@@ -10,6 +10,11 @@ import uuid
 from models import Location, Thing
 from schemas import LocationCreate, LocationUpdate, LocationResponse
 from database import get_db
+from odata_filter import apply_filter
+from expand import expand_query, expand_page
+from serialization import select_query
+from pagination import paginate, collection
+from response_cache import invalidate_responses
 
 router = APIRouter()
 
@@ -17,14 +22,23 @@ router = APIRouter()
 ## LOCATIONS __________________________________________________________
 @router.get("/", response_model=Dict[str, Any])
 def get_locations(
+    request: Request,
     top: int = Query(100, alias="$top"),
     skip: int = Query(0, alias="$skip"),
+    skiptoken: Optional[str] = Query(None, alias="$skiptoken"),
+    count: bool = Query(True, alias="$count"),
+    filter_: Optional[str] = Query(None, alias="$filter"),
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
     db: Session = Depends(get_db)
 ):
     query = db.query(Location)
-    total = query.count()
-    locations = query.offset(skip).limit(top).all()
-    return {"@iot.count": total, "value": locations}
+    query = apply_filter(query, Location, filter_)
+    query, tree = expand_query(query, Location, expand)
+    query, fields = select_query(query, Location, select_)
+    total = query.count() if count else None
+    locations, next_link = paginate(query, request, [Location.id], top, skip, skiptoken)
+    return collection(expand_page(db, locations, Location, tree, fields), total, next_link)
 
 
 @router.post("/", response_model=LocationResponse, status_code=201)
@@ -51,6 +65,7 @@ def create_location(location_data: LocationCreate, db: Session = Depends(get_db)
 
     db.add(db_location)
     db.commit()
+    invalidate_responses(db)
     db.refresh(db_location)
     return db_location
 
@@ -86,6 +101,7 @@ def update_location(
         setattr(location, field, value)
     
     db.commit()
+    invalidate_responses(db)
     db.refresh(location)
     return location
 
@@ -97,12 +113,23 @@ def delete_location(location_id: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Location not found")
     db.delete(location)
     db.commit()
+    invalidate_responses(db)
 
 
 # SensorThings : Things d'une Location
 @router.get("({location_id})/Things", response_model=Dict[str, Any])
-def get_location_things(location_id: str, db: Session = Depends(get_db)):
+def get_location_things(
+    location_id: str,
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
+    db: Session = Depends(get_db)
+):
     location = db.query(Location).filter(Location.id == location_id).first()
     if not location:
         raise HTTPException(status_code=404, detail="Location not found")
-    return {"@iot.count": len(location.Things), "value": location.Things}
+    query, tree = expand_query(
+        db.query(Thing).filter(Thing.Locations.any(Location.id == location_id)), Thing, expand
+    )
+    query, fields = select_query(query, Thing, select_)
+    things = query.all()
+    return {"@iot.count": len(things), "value": expand_page(db, things, Thing, tree, fields)}
@@ -1,60 +1,136 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from sqlalchemy.orm import Session
-from typing import Dict, Any, Optional
+from sqlalchemy.exc import IntegrityError
+from typing import Dict, Any, Callable, Optional
 from datetime import datetime
 import uuid
 
 from models import Observation
 from schemas import ObservationCreate, ObservationUpdate, ObservationResponse
-from database import get_db
+from database import get_db, get_db_runner, Offload
+from odata_filter import apply_filter
+from expand import expand_query, expand_page
+from serialization import select_query, entity_plan, json_response, encoded_response
+from pagination import paginate, collection, count_query, OBSERVATIONS_COUNT_ESTIMATE
+from export import export_observations, negotiate
+from ingest_writer import insert_observations, written_rows
+from latest import latest_cache, refresh_latest
+from routes.datastream import datastream_observations_page
 
 router = APIRouter()
 
 
 ## OBSERVATIONS ______________________________________________________
+def observations_page(
+    db: Session, request: Request, datastream_id, top, skip, skiptoken, orderby, count,
+    filter_, expand, select_, time_start, time_end
+):
+    # Sans $expand / $select : lignes en tuples, encodées directement
+    plan = entity_plan(Observation, expand, select_)
+    query = db.query(*plan.columns) if plan else db.query(Observation)
+    
+    if datastream_id:
+        query = query.filter(Observation.datastream_id == datastream_id)
+    if time_start:
+        query = query.filter(Observation.phenomenonTime >= time_start)
+    if time_end:
+        query = query.filter(Observation.phenomenonTime <= time_end)
+    query = apply_filter(query, Observation, filter_)
+    query, tree = expand_query(query, Observation, expand)
+    query, fields = select_query(query, Observation, select_)
+    
+    # Comptage seulement sur demande : coûteux sur l'hypertable
+    total = None
+    if count:
+        filtered = bool(datastream_id or time_start or time_end or filter_)
+        total = count_query(
+            db, query, filtered,
+            estimate_table="observations" if OBSERVATIONS_COUNT_ESTIMATE else None
+        )
+
+    # Tri, avec datastream_id pour départager les observations de même phenomenonTime
+    keys = [Observation.phenomenonTime]
+    if not datastream_id:
+        keys.append(Observation.datastream_id)
+    observations, next_link = paginate(
+        query, request, keys, top, skip, skiptoken, descending="desc" in orderby
+    )
+
+    # Encodage hors de la boucle d'événements (Offload)
+    if plan:
+        return Offload(lambda: json_response(collection(plan.dicts(observations), total, next_link)))
+    return Offload(encoded_response, collection(expand_page(db, observations, Observation, tree, fields), total, next_link))
+
+
+# Route async : requêtes via asyncpg avec DB_ASYNC_ENABLED, sinon dans le threadpool
 @router.get("/", response_model=Dict[str, Any])
-def get_observations(
+async def get_observations(
+    request: Request,
     # Vos filtres métier
     datastream_id: Optional[str] = None,
     # OData de base
     top: int = Query(100, alias="$top"),
     skip: int = Query(0, alias="$skip"),
+    skiptoken: Optional[str] = Query(None, alias="$skiptoken"),
     orderby: str = Query("phenomenonTime desc", alias="$orderby"),
+    count: bool = Query(False, alias="$count"),
+    filter_: Optional[str] = Query(None, alias="$filter"),
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
     # Filtres temporels utiles pour votre cas
     time_start: Optional[datetime] = None,
     time_end: Optional[datetime] = None,
-    db: Session = Depends(get_db)
+    run: Callable = Depends(get_db_runner)
 ):
-    query = db.query(Observation)
-    
-    if datastream_id:
-        query = query.filter(Observation.datastream_id == datastream_id)
-    if time_start:
-        query = query.filter(Observation.phenomenonTime >= time_start)
-    if time_end:
-        query = query.filter(Observation.phenomenonTime <= time_end)
-    
-    # Tri
-    if "desc" in orderby:
-        query = query.order_by(Observation.phenomenonTime.desc())
-    else:
-        query = query.order_by(Observation.phenomenonTime.asc())
-    
-    total = query.count()
-    observations = query.offset(skip).limit(top).all()
-    
-    return {
-        "@iot.count": total,
-        "value": observations
-    }
+    # Arrow / Parquet (ou NDJSON / CSV) demandés par Accept : la même page, en flux
+    fmt = negotiate(request)
+    if fmt:
+        keys = [Observation.phenomenonTime]
+        if not datastream_id:
+            keys.append(Observation.datastream_id)
+        return export_observations(
+            fmt, datastream_id, time_start, time_end, filter_text=filter_, select_text=select_,
+            top=top, skip=skip, skiptoken=skiptoken, keys=keys, descending="desc" in orderby
+        )
+
+    return await run(
+        observations_page, request, datastream_id, top, skip, skiptoken, orderby, count,
+        filter_, expand, select_, time_start, time_end
+    )
+
+# Export en flux (NDJSON / CSV) : curseur côté serveur, mémoire constante quelle que soit la plage
+@router.get("/export")
+def export_observations_route(
+    format: str = Query("ndjson", description="ndjson, csv, arrow or parquet"),
+    filter_: Optional[str] = Query(None, alias="$filter"),
+    select_: Optional[str] = Query(None, alias="$select"),
+    datastream_id: Optional[str] = None,
+    time_start: Optional[datetime] = None,
+    time_end: Optional[datetime] = None,
+):
+    return export_observations(
+        format, datastream_id, time_start, time_end, filter_text=filter_, select_text=select_
+    )
 
 @router.post("/", response_model=ObservationResponse)
 def create_observation(obs_data: ObservationCreate, db: Session = Depends(get_db)):
-    db_obs = Observation(**obs_data.dict())
-    db.add(db_obs)
-    db.commit()
-    db.refresh(db_obs)
-    return db_obs
+    # Même INSERT que MQTT et CreateObservations : un doublon est ignoré ou remplacé (OBSERVATION_ON_CONFLICT)
+    row = obs_data.dict()
+    try:
+        written = insert_observations(db, [row], returning=True)
+        db.commit()
+    except IntegrityError as e:
+        db.rollback()
+        raise HTTPException(status_code=409, detail=f"Observation not created: {e.orig}")
+    if not written:
+        raise HTTPException(
+            status_code=409, detail="An observation of this datastream already exists at this phenomenonTime"
+        )
+    latest_cache.update(written_rows([row], written))
+    (phenomenon_time, ds_id), = written
+    return db.query(Observation).filter(
+        Observation.phenomenonTime == phenomenon_time, Observation.datastream_id == ds_id
+    ).one()
 
 @router.get("({observation_id})", response_model=ObservationResponse)
 def get_observation(observation_id: int, db: Session = Depends(get_db)):
@@ -78,7 +154,11 @@ def update_observation(
     for field, value in update_data.items():
         setattr(observation, field, value)
     
+    # Dernière observation du datastream recalculée dans la même transaction
+    db.flush()
+    latest = refresh_latest(db, observation.datastream_id)
     db.commit()
+    latest_cache.replace(observation.datastream_id, latest)
     db.refresh(observation)
     return observation
 
@@ -87,31 +167,35 @@ def delete_observation(observation_id: int, db: Session = Depends(get_db)):
     observation = db.query(Observation).filter(Observation.id == observation_id).first()
     if not observation:
         raise HTTPException(status_code=404, detail="Observation not found")
+    datastream_id = observation.datastream_id
     db.delete(observation)
+    # Si c'était la plus récente, /Latest passe à la précédente
+    db.flush()
+    latest = refresh_latest(db, datastream_id)
     db.commit()
+    latest_cache.replace(datastream_id, latest)
     return {"message": "Observation deleted"}
 
-# Route SensorThings : observations d'un datastream spécifique
+# Route SensorThings : observations d'un datastream spécifique, mêmes réponses
+# que /Datastreams({id})/Observations (négociation Accept, max_points, $filter, $expand, $select)
 @router.get("/Datastreams({datastream_id})/Observations", response_model=Dict[str, Any])
-def get_observations_by_datastream(
+async def get_observations_by_datastream(
+    request: Request,
     datastream_id: str,
     top: int = Query(100, alias="$top"),
     skip: int = Query(0, alias="$skip"),
+    skiptoken: Optional[str] = Query(None, alias="$skiptoken"),
+    count: bool = Query(False, alias="$count"),
+    filter_: Optional[str] = Query(None, alias="$filter"),
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
     time_start: Optional[datetime] = None,
     time_end: Optional[datetime] = None,
-    db: Session = Depends(get_db)
+    max_points: Optional[int] = Query(None, ge=3, le=100000, description="Downsample the range to this many points"),
+    downsample: str = Query("lttb", description="Downsampling method with max_points: lttb or minmax"),
+    run: Callable = Depends(get_db_runner)
 ):
-    query = db.query(Observation).filter(Observation.datastream_id == datastream_id)
-    
-    if time_start:
-        query = query.filter(Observation.phenomenonTime >= time_start)
-    if time_end:
-        query = query.filter(Observation.phenomenonTime <= time_end)
-    
-    total = query.count()
-    observations = query.offset(skip).limit(top).order_by(Observation.phenomenonTime.desc()).all()
-    
-    return {
-        "@iot.count": total,
-        "value": observations
-    }
+    return await run(
+        datastream_observations_page, request, datastream_id, top, skip, skiptoken, count, filter_,
+        expand, select_, time_start, time_end, max_points, downsample
+    )
@@ -1,12 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from sqlalchemy.orm import Session
 from typing import Dict, Any, Optional
 from datetime import datetime
 import uuid
 
-from models import ObservedProperty
+from models import ObservedProperty, Datastream
 from schemas import ObservedPropertyCreate, ObservedPropertyUpdate, ObservedPropertyResponse
 from database import get_db
+from odata_filter import apply_filter
+from expand import expand_query, expand_page
+from serialization import select_query
+from pagination import paginate, collection
+from response_cache import invalidate_responses
+from topic_cache import invalidate_topics
 
 router = APIRouter()
 
@@ -14,14 +20,23 @@ router = APIRouter()
 ## OBSERVED PROPERTIES _______________________________________________
 @router.get("/", response_model=Dict[str, Any])
 def get_observed_properties(
+    request: Request,
     top: int = Query(100, alias="$top"),
     skip: int = Query(0, alias="$skip"),
+    skiptoken: Optional[str] = Query(None, alias="$skiptoken"),
+    count: bool = Query(True, alias="$count"),
+    filter_: Optional[str] = Query(None, alias="$filter"),
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
     db: Session = Depends(get_db)
 ):
     query = db.query(ObservedProperty)
-    total = query.count()  # ← Vrai total
-    props = query.offset(skip).limit(top).all()
-    return {"@iot.count": total, "value": props}
+    query = apply_filter(query, ObservedProperty, filter_)
+    query, tree = expand_query(query, ObservedProperty, expand)
+    query, fields = select_query(query, ObservedProperty, select_)
+    total = query.count() if count else None
+    props, next_link = paginate(query, request, [ObservedProperty.id], top, skip, skiptoken)
+    return collection(expand_page(db, props, ObservedProperty, tree, fields), total, next_link)
 
 
 @router.post("/", response_model=ObservedPropertyResponse, status_code=201)
@@ -33,6 +48,7 @@ def create_observed_property(prop_data: ObservedPropertyCreate, db: Session = De
     )
     db.add(db_prop)
     db.commit()
+    invalidate_responses(db)
     db.refresh(db_prop)
     return db_prop
 
@@ -59,7 +75,10 @@ def update_observed_property(
         setattr(prop, field, value)
     
     db.commit()
+    invalidate_responses(db)
     db.refresh(prop)
+    # Topics may address the property by name
+    invalidate_topics(db)
     return prop
 
 
@@ -70,12 +89,24 @@ def delete_observed_property(prop_id: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="ObservedProperty not found")
     db.delete(prop)
     db.commit()
+    invalidate_responses(db)
+    invalidate_topics(db)
 
 
 # SensorThings : Datastreams d'une ObservedProperty
 @router.get("({prop_id})/Datastreams", response_model=Dict[str, Any])
-def get_observed_property_datastreams(prop_id: str, db: Session = Depends(get_db)):
+def get_observed_property_datastreams(
+    prop_id: str,
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
+    db: Session = Depends(get_db)
+):
     prop = db.query(ObservedProperty).filter(ObservedProperty.id == prop_id).first()
     if not prop:
         raise HTTPException(status_code=404, detail="ObservedProperty not found")
-    return {"@iot.count": len(prop.Datastreams), "value": prop.Datastreams}
+    query, tree = expand_query(
+        db.query(Datastream).filter(Datastream.observed_property_id == prop_id), Datastream, expand
+    )
+    query, fields = select_query(query, Datastream, select_)
+    datastreams = query.all()
+    return {"@iot.count": len(datastreams), "value": expand_page(db, datastreams, Datastream, tree, fields)}
@@ -1,12 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from sqlalchemy.orm import Session
 from typing import Dict, Any, Optional
 from datetime import datetime
 import uuid
 
-from models import Sensor
+from models import Sensor, Datastream
 from schemas import SensorCreate, SensorUpdate, SensorResponse
 from database import get_db
+from odata_filter import apply_filter
+from expand import expand_query, expand_page
+from serialization import select_query
+from pagination import paginate, collection
+from response_cache import invalidate_responses
 
 router = APIRouter()
 
@@ -14,14 +19,23 @@ router = APIRouter()
 ## SENSORS ___________________________________________________________
 @router.get("/", response_model=Dict[str, Any])
 def get_sensors(
+    request: Request,
     top: int = Query(100, alias="$top"),
     skip: int = Query(0, alias="$skip"),
+    skiptoken: Optional[str] = Query(None, alias="$skiptoken"),
+    count: bool = Query(True, alias="$count"),
+    filter_: Optional[str] = Query(None, alias="$filter"),
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
     db: Session = Depends(get_db)
 ):
     query = db.query(Sensor)
-    total = query.count()
-    sensors = query.offset(skip).limit(top).all()
-    return {"@iot.count": total, "value": sensors}
+    query = apply_filter(query, Sensor, filter_)
+    query, tree = expand_query(query, Sensor, expand)
+    query, fields = select_query(query, Sensor, select_)
+    total = query.count() if count else None
+    sensors, next_link = paginate(query, request, [Sensor.id], top, skip, skiptoken)
+    return collection(expand_page(db, sensors, Sensor, tree, fields), total, next_link)
 
 
 @router.post("/", response_model=SensorResponse, status_code=201)
@@ -34,6 +48,7 @@ def create_sensor(sensor_data: SensorCreate, db: Session = Depends(get_db)):
     )
     db.add(db_sensor)
     db.commit()
+    invalidate_responses(db)
     db.refresh(db_sensor)
     return db_sensor
 
@@ -66,6 +81,7 @@ def update_sensor(
         setattr(sensor, field, value)
 
     db.commit()
+    invalidate_responses(db)
     db.refresh(sensor)
     return sensor
 
@@ -77,12 +93,23 @@ def delete_sensor(sensor_id: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Sensor not found")
     db.delete(sensor)
     db.commit()
+    invalidate_responses(db)
 
 
 # SensorThings : Datastreams d'un Sensor
 @router.get("({sensor_id})/Datastreams", response_model=Dict[str, Any])
-def get_sensor_datastreams(sensor_id: str, db: Session = Depends(get_db)):
+def get_sensor_datastreams(
+    sensor_id: str,
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
+    db: Session = Depends(get_db)
+):
     sensor = db.query(Sensor).filter(Sensor.id == sensor_id).first()
     if not sensor:
         raise HTTPException(status_code=404, detail="Sensor not found")
-    return {"@iot.count": len(sensor.Datastreams), "value": sensor.Datastreams}
+    query, tree = expand_query(
+        db.query(Datastream).filter(Datastream.sensor_id == sensor_id), Datastream, expand
+    )
+    query, fields = select_query(query, Datastream, select_)
+    datastreams = query.all()
+    return {"@iot.count": len(datastreams), "value": expand_page(db, datastreams, Datastream, tree, fields)}
@@ -1,12 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from sqlalchemy.orm import Session
 from typing import Dict, Any, Optional
 from datetime import datetime
 import uuid
 
-from models import Thing
+from models import Thing, Location, Datastream
 from schemas import ThingCreate, ThingUpdate, ThingResponse
 from database import get_db
+from odata_filter import apply_filter
+from expand import expand_query, expand_page
+from serialization import select_query
+from pagination import paginate, collection
+from response_cache import invalidate_responses
+from topic_cache import invalidate_topics
 
 router = APIRouter()
 
@@ -14,14 +20,23 @@ router = APIRouter()
 ## THINGS ____________________________________________________________
 @router.get("/", response_model=Dict[str, Any])
 def get_things(
+    request: Request,
     top: int = Query(100, alias="$top"),
     skip: int = Query(0, alias="$skip"),
+    skiptoken: Optional[str] = Query(None, alias="$skiptoken"),
+    count: bool = Query(True, alias="$count"),
+    filter_: Optional[str] = Query(None, alias="$filter"),
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
     db: Session = Depends(get_db)
 ):
     query = db.query(Thing)
-    total = query.count()
-    things = query.offset(skip).limit(top).all()
-    return {"@iot.count": total, "value": things}
+    query = apply_filter(query, Thing, filter_)
+    query, tree = expand_query(query, Thing, expand)
+    query, fields = select_query(query, Thing, select_)
+    total = query.count() if count else None
+    things, next_link = paginate(query, request, [Thing.id], top, skip, skiptoken)
+    return collection(expand_page(db, things, Thing, tree, fields), total, next_link)
 
 
 @router.post("/", response_model=ThingResponse, status_code=201)
@@ -42,7 +57,9 @@ def create_thing(thing_data: ThingCreate, db: Session = Depends(get_db)):
 
     db.add(db_thing)
     db.commit()
+    invalidate_responses(db)
     db.refresh(db_thing)
+    invalidate_topics(db, db_thing.id)
     return db_thing
 
 
@@ -77,7 +94,9 @@ def update_thing(
         setattr(thing, field, value)
 
     db.commit()
+    invalidate_responses(db)
     db.refresh(thing)
+    invalidate_topics(db, thing_id)
     return thing
 
 
@@ -88,21 +107,43 @@ def delete_thing(thing_id: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Thing not found")
     db.delete(thing)
     db.commit()
+    invalidate_responses(db)
+    invalidate_topics(db, thing_id)
 
 
 # SensorThings : Locations d'un Thing
 @router.get("({thing_id})/Locations", response_model=Dict[str, Any])
-def get_thing_locations(thing_id: str, db: Session = Depends(get_db)):
+def get_thing_locations(
+    thing_id: str,
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
+    db: Session = Depends(get_db)
+):
     thing = db.query(Thing).filter(Thing.id == thing_id).first()
     if not thing:
         raise HTTPException(status_code=404, detail="Thing not found")
-    return {"@iot.count": len(thing.Locations), "value": thing.Locations}
+    query, tree = expand_query(
+        db.query(Location).filter(Location.Things.any(Thing.id == thing_id)), Location, expand
+    )
+    query, fields = select_query(query, Location, select_)
+    locations = query.all()
+    return {"@iot.count": len(locations), "value": expand_page(db, locations, Location, tree, fields)}
 
 
 # SensorThings : Datastreams d'un Thing
 @router.get("({thing_id})/Datastreams", response_model=Dict[str, Any])
-def get_thing_datastreams(thing_id: str, db: Session = Depends(get_db)):
+def get_thing_datastreams(
+    thing_id: str,
+    expand: Optional[str] = Query(None, alias="$expand"),
+    select_: Optional[str] = Query(None, alias="$select"),
+    db: Session = Depends(get_db)
+):
     thing = db.query(Thing).filter(Thing.id == thing_id).first()
     if not thing:
         raise HTTPException(status_code=404, detail="Thing not found")
-    return {"@iot.count": len(thing.Datastreams), "value": thing.Datastreams}
+    query, tree = expand_query(
+        db.query(Datastream).filter(Datastream.thing_id == thing_id), Datastream, expand
+    )
+    query, fields = select_query(query, Datastream, select_)
+    datastreams = query.all()
+    return {"@iot.count": len(datastreams), "value": expand_page(db, datastreams, Datastream, tree, fields)}
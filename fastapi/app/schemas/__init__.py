@@ -32,6 +32,8 @@ from .observation import (
     ObservationCreate,
     ObservationUpdate,
     ObservationResponse,
+    ObservationDataArray,
+    DATA_ARRAY_COMPONENTS,
 )
 
 from .location import (
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from typing import Optional, Dict, Any, List
 from datetime import datetime
 
@@ -30,3 +30,52 @@ class ObservationResponse(ObservationBase):
 
     class Config:
         from_attributes = True 
+
+
+## CREATE OBSERVATIONS (dataArray) _______
+DATA_ARRAY_COMPONENTS = {
+    "phenomenonTime": "phenomenonTime",
+    "resultTime": "resultTime",
+    "result": "result",
+    "resultQuality": "resultQuality",
+    "parameters": "parameters",
+    "FeatureOfInterest/id": "feature_of_interest_id",
+}
+
+class EntityReference(BaseModel):
+    id: str = Field(alias="@iot.id")
+
+    class Config:
+        populate_by_name = True
+        coerce_numbers_to_str = True
+
+class ObservationDataArray(BaseModel):
+    """Conforme SensorThings CreateObservations"""
+    Datastream: EntityReference
+    components: List[str]
+    dataArray_count: Optional[int] = Field(None, alias="dataArray@iot.count")
+    dataArray: List[List[Any]]
+
+    class Config:
+        populate_by_name = True
+        json_schema_extra = {
+            "example": {
+                "Datastream": {"@iot.id": "uuid-du-datastream"},
+                "components": ["phenomenonTime", "result"],
+                "dataArray@iot.count": 2,
+                "dataArray": [
+                    ["2024-01-01T10:00:00Z", 20.1],
+                    ["2024-01-01T10:01:00Z", 20.3]
+                ]
+            }
+        }
+
+    @field_validator("components")
+    @classmethod
+    def check_components(cls, components):
+        unknown = [c for c in components if c not in DATA_ARRAY_COMPONENTS]
+        if unknown:
+            raise ValueError(f"Unsupported components: {unknown}")
+        if "result" not in components:
+            raise ValueError("components must include 'result'")
+        return components
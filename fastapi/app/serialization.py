@@ -0,0 +1,165 @@
+import typing
+from functools import lru_cache
+import orjson
+from fastapi import HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from geoalchemy2.elements import WKBElement
+from geoalchemy2.shape import to_shape
+from shapely.geometry import mapping
+from pydantic import BaseModel
+from sqlalchemy.orm import load_only
+
+from models import Observation, Datastream
+from schemas import ObservationResponse, DatastreamResponse
+from odata_filter import NAVIGATION
+
+
+## ENTITY DICTS _______________________________________________________
+# SensorThings representation of ORM entities: every column, by database
+# column name (Sensor.metadata_ -> "metadata"), geometries as GeoJSON,
+# and only the navigation properties asked for by $expand.
+
+def _columns(model):
+    return [(prop.key, prop.columns[0].name) for prop in model.__mapper__.column_attrs]
+
+
+def _value(value):
+    if isinstance(value, WKBElement):
+        return mapping(to_shape(value))
+    return value
+
+
+def entity(obj, select=None, expand=None):
+    """Dict of an entity with its `select` properties (all when None) and `expand` tree"""
+    data = {"@iot.id": getattr(obj, "id", None)}
+    for key, name in _columns(type(obj)):
+        if select is None or name in select or key in select:
+            data[name] = _value(getattr(obj, key))
+    for name, node in (expand or {}).items():
+        related = getattr(obj, name)
+        if isinstance(related, list):
+            data[name] = [entity(child, node.select, node.expand) for child in node.window(related)]
+        else:
+            data[name] = None if related is None else entity(related, node.select, node.expand)
+    return data
+
+
+def entities(objs, select=None, expand=None):
+    return [entity(obj, select, expand) for obj in objs]
+
+
+## $SELECT ____________________________________________________________
+@lru_cache(maxsize=256)
+def parse_select(text):
+    return frozenset(name.strip() for name in text.split(",") if name.strip())
+
+
+def select_columns(model, select):
+    """Mapped columns to load for `select`: the selected ones, plus the id, primary
+    and foreign keys that paging and $expand rely on. Unselected JSONB / geometry
+    columns are not read at all (nor decompressed, on compressed chunks)."""
+    columns = []
+    names = set(select) - set(NAVIGATION.get(model, {})) - {"@iot.id"}
+    for key, name in _columns(model):
+        column = model.__mapper__.columns[key]
+        if key in names or name in names:
+            names.discard(key)
+            names.discard(name)
+            columns.append(getattr(model, key))
+        elif column.primary_key or column.foreign_keys or key == "id":
+            columns.append(getattr(model, key))
+    if names:
+        raise HTTPException(status_code=400, detail=f"Unknown $select properties of {model.__name__}: {sorted(names)}")
+    return columns
+
+
+def select_query(query, model, text):
+    """(query loading only the $select columns, selected names), unchanged without $select"""
+    if not text:
+        return query, None
+    select = parse_select(text)
+    return query.options(load_only(*select_columns(model, select))), select
+
+
+## FAST COLLECTIONS ___________________________________________________
+# Plain collection pages (no $expand / $select) of large entity sets skip
+# the ORM and FastAPI's reflective jsonable_encoder: rows are read as tuples
+# of the columns a *Response schema needs, turned into dicts by a field plan
+# compiled once from that schema, and encoded by orjson. The JSON is the one
+# the schema gives: same keys (aliases), same order, same datetime format.
+
+def _nested_model(annotation):
+    """BaseModel class of a (possibly Optional) field annotation, else None"""
+    for candidate in (annotation, *typing.get_args(annotation)):
+        if isinstance(candidate, type) and issubclass(candidate, BaseModel):
+            return candidate
+    return None
+
+
+def _projection(schema):
+    """Dict of a JSONB value with the keys of a nested schema, in its order"""
+    keys = [field.alias or name for name, field in schema.model_fields.items()]
+    return lambda value: None if value is None else {key: value.get(key) for key in keys}
+
+
+class EntityPlan:
+    """Columns to read and dict to build for each row, from a *Response schema.
+
+    A schema field is read from the mapped column of the same name (or
+    alias), converted when it is a nested schema, and set to its default
+    when the model has no such column (e.g. derived id lists).
+    """
+
+    def __init__(self, model, schema):
+        columns = {prop.key: prop.columns[0] for prop in model.__mapper__.column_attrs}
+        self.columns = []
+        self.fields = []  # (output key, row index or None, convert, default)
+        for name, field in schema.model_fields.items():
+            source = field.validation_alias if isinstance(field.validation_alias, str) else field.alias or name
+            key = field.serialization_alias or field.alias or name
+            nested = _nested_model(field.annotation)
+            convert = _projection(nested) if nested else None
+            if source in columns:
+                self.fields.append((key, len(self.columns), convert, None))
+                self.columns.append(getattr(model, source))
+            else:
+                self.fields.append((key, None, None, field.get_default(call_default_factory=True)))
+        # Most plans only copy the row values, in column order
+        self._direct = all(index == i and convert is None for i, (_, index, convert, _) in enumerate(self.fields))
+        self._keys = [key for key, _, _, _ in self.fields]
+
+    def dicts(self, rows):
+        if self._direct:
+            keys = self._keys
+            return [dict(zip(keys, row)) for row in rows]
+        return [
+            {
+                key: default if index is None else (convert(row[index]) if convert else row[index])
+                for key, index, convert, default in self.fields
+            }
+            for row in rows
+        ]
+
+
+ENTITY_PLANS = {
+    Observation: EntityPlan(Observation, ObservationResponse),
+    Datastream: EntityPlan(Datastream, DatastreamResponse),
+}
+
+
+def entity_plan(model, expand=None, select=None):
+    """Plan of the fast path for a collection of `model`, None when it does not apply"""
+    if expand or select:
+        return None
+    return ENTITY_PLANS.get(model)
+
+
+def json_response(content):
+    """orjson-encoded JSON response, with datetimes written as Pydantic does (UTC as "Z")"""
+    return Response(orjson.dumps(content, option=orjson.OPT_UTC_Z), media_type="application/json")
+
+
+def encoded_response(content):
+    """JSON response of `content` encoded as FastAPI encodes a route's return value"""
+    return JSONResponse(jsonable_encoder(content))
@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+from sqlalchemy.exc import OperationalError, InterfaceError
+
+from metrics import SPOOL_BYTES
+
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = os.getenv("SPOOL_DIR", "/app/spool")
+SPOOL_SEGMENT_BYTES = int(os.getenv("SPOOL_SEGMENT_BYTES", 16 * 1024 * 1024))
+# Disk quota for all segments of one spool, new records are refused beyond it
+SPOOL_MAX_BYTES = int(os.getenv("SPOOL_MAX_BYTES", 1024 * 1024 * 1024))
+# always | interval | never
+SPOOL_FSYNC = os.getenv("SPOOL_FSYNC", "interval")
+SPOOL_FSYNC_INTERVAL_MS = int(os.getenv("SPOOL_FSYNC_INTERVAL_MS", 1000))
+SPOOL_REPLAY_BATCH = int(os.getenv("SPOOL_REPLAY_BATCH", 5000))
+SPOOL_RETRY_INTERVAL = float(os.getenv("SPOOL_RETRY_INTERVAL", 5))
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+# Errors meaning "database unreachable": keep the records and retry later
+RETRYABLE_ERRORS = (OperationalError, InterfaceError)
+
+SEGMENT_SUFFIX = ".seg"
+CHECKPOINT_FILE = "checkpoint.json"
+REJECTED_FILE = "rejected.jsonl"
+
+
+class SpoolFull(Exception):
+    pass
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+## SPOOL ______________________________________________________________
+class Spool:
+    """Segment-based on-disk log of JSON records, replayed in order into `sink`.
+
+    Records are appended as JSON lines to numbered segment files. A background
+    replayer reads them back in batches of `replay_batch`, passes each batch
+    to `sink(records)` and only then moves the checkpoint forward, so replay
+    resumes where it stopped after a restart. Records the sink returns, or all
+    those of a batch it raises on, are set aside in the rejected file. Fully replayed segments are
+    deleted.
+    """
+
+    def __init__(
+        self,
+        directory,
+        sink,
+        segment_bytes=SPOOL_SEGMENT_BYTES,
+        max_bytes=SPOOL_MAX_BYTES,
+        fsync=SPOOL_FSYNC,
+        fsync_interval_ms=SPOOL_FSYNC_INTERVAL_MS,
+        replay_batch=SPOOL_REPLAY_BATCH,
+        retry_interval=SPOOL_RETRY_INTERVAL,
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync!r}, expected one of {FSYNC_POLICIES}")
+        self.directory = directory
+        self.sink = sink
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval_ms / 1000
+        self.replay_batch = replay_batch
+        self.retry_interval = retry_interval
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._file = None
+        self._last_fsync = time.monotonic()
+
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self._segments()
+        self._size = sum(os.path.getsize(self._path(s)) for s in segments)
+        self._checkpoint = self._read_checkpoint(segments)
+        self._active = max(segments[-1] if segments else 0, self._checkpoint[0])
+        SPOOL_BYTES.labels(os.path.basename(directory)).set_function(lambda: self._size)
+
+    # -- writing -------------------------------------------------------
+    def append(self, records):
+        if not records:
+            return
+        data = "".join(json.dumps(r, default=_json_default) + "\n" for r in records).encode()
+        with self._lock:
+            if self._size + len(data) > self.max_bytes:
+                raise SpoolFull(f"Spool {self.directory} over quota ({self.max_bytes} bytes)")
+            if self._file is None:
+                self._file = open(self._path(self._active), "ab")
+            elif self._file.tell() + len(data) > self.segment_bytes and self._file.tell() > 0:
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+            self._sync()
+        self._wakeup.set()
+
+    def pending(self):
+        """True while some records have not been replayed yet"""
+        with self._lock:
+            segment, offset = self._checkpoint
+            if segment < self._active:
+                return True
+            return os.path.exists(self._path(segment)) and os.path.getsize(self._path(segment)) > offset
+
+    def _rotate(self):
+        self._file.flush()
+        if self.fsync != "never":
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._active += 1
+        self._file = open(self._path(self._active), "ab")
+
+    def _sync(self):
+        if self.fsync == "always" or (
+            self.fsync == "interval" and time.monotonic() - self._last_fsync >= self.fsync_interval
+        ):
+            os.fsync(self._file.fileno())
+            self._last_fsync = time.monotonic()
+
+    # -- replay --------------------------------------------------------
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="spool-replayer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                if self.fsync != "never":
+                    os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+
+    def replay(self):
+        """Replay until the spool is empty, return the number of records sent to the sink"""
+        total = 0
+        while True:
+            records, position = self._read_batch()
+            if not records:
+                self._advance(position)
+                return total
+            try:
+                rejected = self.sink(records)
+            except RETRYABLE_ERRORS:
+                raise
+            except Exception:
+                # A batch the database refuses for good must not block the ones after it
+                logger.exception("Spool %s: rejecting %d records", self.directory, len(records))
+                rejected = records
+            if rejected:
+                self._reject(rejected)
+            self._advance(position)
+            total += len(records)
+
+    def _reject(self, records):
+        with open(os.path.join(self.directory, REJECTED_FILE), "a") as f:
+            for record in records:
+                f.write(json.dumps(record, default=_json_default) + "\n")
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            try:
+                replayed = self.replay()
+                if replayed:
+                    logger.info("Spool %s: replayed %d records", self.directory, replayed)
+                self._wakeup.wait(self.retry_interval)
+            except RETRYABLE_ERRORS as e:
+                logger.warning("Spool %s: database unavailable, retrying in %ss (%s)",
+                               self.directory, self.retry_interval, e.__class__.__name__)
+                self._stop.wait(self.retry_interval)
+            except Exception:
+                logger.exception("Spool %s: replay failed", self.directory)
+                self._stop.wait(self.retry_interval)
+
+    def _read_batch(self):
+        """Next complete records after the checkpoint, and the position after them"""
+        records = []
+        segment, offset = self._checkpoint
+        with self._lock:
+            active = self._active
+        while len(records) < self.replay_batch:
+            path = self._path(segment)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    while len(records) < self.replay_batch:
+                        line = f.readline()
+                        # A line without newline is still being written
+                        if not line.endswith(b"\n"):
+                            break
+                        offset += len(line)
+                        records.append(json.loads(line))
+                    else:
+                        break
+            if segment >= active:
+                break
+            segment, offset = segment + 1, 0
+        return records, (segment, offset)
+
+    def _advance(self, position):
+        segment, offset = position
+        with self._lock:
+            # Caught up with the writer: start a new segment so this one can go
+            if (segment == self._active and self._file is not None
+                    and offset > 0 and offset == self._file.tell()):
+                self._rotate()
+                segment, offset = self._active, 0
+            previous = self._checkpoint[0]
+            self._checkpoint = (segment, offset)
+            self._write_checkpoint()
+            # Segments before the checkpoint are fully replayed
+            for s in range(previous, segment):
+                path = self._path(s)
+                if os.path.exists(path):
+                    self._size -= os.path.getsize(path)
+                    os.remove(path)
+
+    # -- files ---------------------------------------------------------
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:020d}{SEGMENT_SUFFIX}")
+
+    def _segments(self):
+        return sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def _read_checkpoint(self, segments):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as f:
+                data = json.load(f)
+            return (data["segment"], data["offset"])
+        except (OSError, ValueError, KeyError):
+            return (segments[0] if segments else 0), 0
+
+    def _write_checkpoint(self):
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"segment": self._checkpoint[0], "offset": self._checkpoint[1]}, f)
+            f.flush()
+            if self.fsync != "never":
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
@@ -0,0 +1,122 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+
+import cache_channel
+from models import Datastream, ObservedProperty
+from database import IngestSessionLocal
+
+
+TOPIC_CACHE_SIZE = int(os.getenv("TOPIC_CACHE_SIZE", 10000))
+# Resolved topics are refreshed after this delay, unknown topics are retried after the negative one (seconds)
+TOPIC_CACHE_TTL = float(os.getenv("TOPIC_CACHE_TTL", 300))
+TOPIC_CACHE_NEGATIVE_TTL = float(os.getenv("TOPIC_CACHE_NEGATIVE_TTL", 30))
+# Invalidation key, on cache_channel, of every topic (otherwise a Thing id)
+ALL_TOPICS = "*"
+
+
+def lookup_datastream_id(session: Session, thing_id, observed_property):
+    """Datastream of a Thing measuring an ObservedProperty, given by id or name"""
+    row = session.query(Datastream.id).join(
+        ObservedProperty, Datastream.observed_property_id == ObservedProperty.id
+    ).filter(
+        Datastream.thing_id == thing_id,
+        or_(ObservedProperty.id == observed_property,
+            ObservedProperty.name == observed_property)
+    ).first()
+    return row[0] if row else None
+
+
+## TOPIC CACHE ________________________________________________________
+class TopicCache:
+    """Bounded LRU cache resolving iot/<thing>/<property> topics to Datastream ids.
+
+    Unknown topics are cached as negative entries (None) so that messages on
+    unrouted topics do not hit the database either.
+    """
+
+    def __init__(
+        self,
+        max_size=TOPIC_CACHE_SIZE,
+        ttl=TOPIC_CACHE_TTL,
+        negative_ttl=TOPIC_CACHE_NEGATIVE_TTL,
+        session_factory=IngestSessionLocal,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.session_factory = session_factory
+
+        self._entries = OrderedDict()  # (thing_id, property) -> (datastream_id, expires_at)
+        self._lock = threading.Lock()
+        # Bumped on every invalidation, so a lookup racing with it is not cached
+        self._generation = 0
+
+    def resolve(self, thing_id, observed_property):
+        key = (thing_id, observed_property)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                return entry[0]
+            generation = self._generation
+
+        session: Session = self.session_factory()
+        try:
+            ds_id = lookup_datastream_id(session, thing_id, observed_property)
+        finally:
+            session.close()
+
+        ttl = self.ttl if ds_id is not None else self.negative_ttl
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = (ds_id, time.monotonic() + ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return ds_id
+
+    def invalidate_thing(self, thing_id):
+        """Forget every topic of a Thing"""
+        with self._lock:
+            self._generation += 1
+            for key in [k for k in self._entries if k[0] == thing_id]:
+                del self._entries[key]
+
+    def invalidate_datastream(self, datastream_id):
+        """Forget every topic routed to a Datastream"""
+        with self._lock:
+            self._generation += 1
+            for key in [k for k, (ds_id, _) in self._entries.items() if ds_id == datastream_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def notified(self, key):
+        """Apply an invalidation received on cache_channel: a Thing id, "*" or None for all topics"""
+        if key in (None, ALL_TOPICS):
+            self.clear()
+        else:
+            self.invalidate_thing(key)
+
+
+topic_cache = TopicCache()
+
+
+cache_channel.subscribe("topics", topic_cache.notified)
+
+
+def invalidate_topics(db: Session, thing_id=None):
+    """Forget the topics of a Thing (every topic without one) in every process.
+    Call after the write has been committed."""
+    cache_channel.publish(db, "topics", ALL_TOPICS if thing_id is None else str(thing_id))